@@ -0,0 +1,430 @@
+#!/usr/bin/python
+
+# run as 'python benchmark.py --help'
+
+from __future__ import with_statement
+import sys, os, time, random, tempfile, shutil, optparse, csv, json, platform, multiprocessing
+from qbexport import *
+
+
+# leaf accounts of the synthetic chart of accounts, nested as they are in a
+# quickbooks general ledger report
+ACCOUNTS = {
+    'bank': [('Checking',), ('Savings',)],
+    'expense': [('Expenses', 'Office'), ('Expenses', 'Phone'), ('Expenses', 'Rent'),
+                ('Expenses', 'Utilities', 'Electric'), ('Expenses', 'Utilities', 'Water')],
+    'income': [('Income', 'Sales'), ('Income', 'Interest'), ('Income', 'Services')],
+}
+
+# share of each kind of transaction in the synthetic export, invoices being
+# a type the converter has no handler for
+MIX = [('Check', 52), ('Deposit', 30), ('Void', 5), ('Transfer', 6), ('General Journal', 4), ('Invoice', 3)]
+
+LAYOUTS = {
+    'debitcredit': ['', 'Trans #', 'Type', 'Date', 'Num', 'Name', 'Memo', 'Clr', 'Split', 'Debit', 'Credit', 'Balance'],
+    'amount': ['', 'Trans #', 'Type', 'Date', 'Num', 'Name', 'Memo', 'Clr', 'Split', 'Amount', 'Balance'],
+}
+
+
+class ExportWriter(object):
+    """ Writes a synthetic quickbooks export.  Rows are spooled to one
+    temporary file per account, so exports of millions of rows can be
+    written without holding them in memory. """
+
+    def __init__(self, filename, layout='debitcredit', seed=0):
+        self.filename = filename
+        self.layout = layout
+        self.random = random.Random(seed)
+        self.directory = tempfile.mkdtemp()
+        self.accounts = {}
+        self.balances = collections.defaultdict(int)
+        self.kinds = []
+        for kind, weight in MIX:
+            self.kinds.extend([kind] * weight)
+        self.rows = 0
+
+    def account_file(self, account):
+        if account not in self.accounts:
+            f = open(os.path.join(self.directory, '%d.csv' % len(self.accounts)), 'w+')
+            self.accounts[account] = (f, csv.writer(f))
+        return self.accounts[account][1]
+
+    def add_row(self, account, transId, tType, date, num, name, memo, split, amount):
+        """ Spool one row, amount being positive for a debit and negative for a credit """
+        self.balances[account] += amount
+        if self.layout == 'amount':
+            amounts = [cents(amount)]
+        elif amount < 0:
+            amounts = ['', cents(-amount)]
+        else:
+            amounts = [cents(amount), '']
+        self.account_file(account).writerow(['', transId, tType, date, num, name, memo, ''] + [split] + amounts +
+                                            [cents(self.balances[account])])
+        self.rows += 1
+
+    def add_transaction(self, transId):
+        rand = self.random
+        kind = rand.choice(self.kinds)
+        date = '%s/%s/%s' % (rand.randint(1, 12), rand.randint(1, 28), rand.randint(2000, 2010))
+        name = 'Payee %s' % rand.randint(1, 2000)
+        memo = rand.choice(['', '', 'monthly', 'invoice %s' % rand.randint(100, 999), 'refund, partial'])
+        bank = rand.choice(ACCOUNTS['bank'])
+
+        if kind == 'Void':
+            other = rand.choice(ACCOUNTS['expense'])
+            self.add_row(bank, transId, 'Check', date, transId, name, 'VOID: ' + memo, ':'.join(other), 0)
+            self.add_row(other, transId, 'Check', date, transId, name, 'VOID: ' + memo, ':'.join(bank), 0)
+            return
+
+        if kind in ('Transfer', 'General Journal', 'Invoice'):
+            if kind == 'Transfer':
+                other = ACCOUNTS['bank'][1 - ACCOUNTS['bank'].index(bank)]
+            else:
+                other = rand.choice(ACCOUNTS['income' if kind == 'Invoice' else 'expense'])
+            amount = rand.randint(1, 500000)
+            self.add_row(bank, transId, kind, date, '', name, memo, ':'.join(other), -amount)
+            self.add_row(other, transId, kind, date, '', name, memo, ':'.join(bank), amount)
+            return
+
+        # checks pay out to one to four expense accounts, deposits come in from one to three income accounts
+        if kind == 'Check':
+            others = rand.sample(ACCOUNTS['expense'], rand.randint(1, 4))
+            sign, num = -1, transId
+        else:
+            others = rand.sample(ACCOUNTS['income'], rand.randint(1, 3))
+            sign, num = 1, ''
+        amounts = [ rand.randint(1, 500000) for other in others ]
+        split = ':'.join(others[0]) if len(others) == 1 else '-SPLIT-'
+
+        self.add_row(bank, transId, kind, date, num, name, memo, split, sign * sum(amounts))
+        for other, amount in zip(others, amounts):
+            self.add_row(other, transId, kind, date, num, name, memo, ':'.join(bank), -sign * amount)
+
+    def write(self, rows):
+        """ Write transactions until the export holds at least rows data rows """
+        try:
+            transId = 0
+            while self.rows < rows:
+                transId += 1
+                self.add_transaction(transId)
+            self.assemble()
+        finally:
+            for f, writer in self.accounts.itervalues():
+                f.close()
+            shutil.rmtree(self.directory)
+
+    def assemble(self):
+        """ Join the spooled accounts into one report with nested account headers and totals """
+        columns = LAYOUTS[self.layout]
+        empty = [''] * (len(columns) - 1)
+
+        with open(self.filename, 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+
+            stack = []
+            for account in sorted(self.accounts):
+                # close the sections that this account is not part of, then open its own
+                while stack and tuple(stack) != account[:len(stack)]:
+                    writer.writerow(['Total ' + stack.pop()] + empty)
+                for name in account[len(stack):]:
+                    writer.writerow([name] + empty)
+                    stack.append(name)
+
+                f = self.accounts[account][0]
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+            while stack:
+                writer.writerow(['Total ' + stack.pop()] + empty)
+            writer.writerow(['TOTAL'] + empty)
+
+def write_export(filename, rows, layout='debitcredit', seed=0):
+    """ Write a synthetic quickbooks export of about rows data rows """
+    ExportWriter(filename, layout, seed).write(rows)
+
+def cents(amount):
+    return format_amount(amount)
+
+def peak_memory():
+    """ Peak resident memory of this process in kilobytes, or None if it
+    can't be found out on this platform """
+    try:
+        import resource
+    except ImportError:
+        return windows_peak_memory()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def windows_peak_memory():
+    """ Peak working set of this process in kilobytes, from the process
+    memory counters of windows """
+    try:
+        import ctypes
+    except ImportError:
+        return None
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        # a DWORD is an unsigned long on windows
+        _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+                   [ (name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize',
+                                                          'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                                                          'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                                                          'PagefileUsage', 'PeakPagefileUsage') ]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    try:
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+    except (AttributeError, OSError):
+        return None
+    return counters.PeakWorkingSetSize // 1024
+
+
+def time_stages(filename, iif_filename):
+    """ Time each stage of the in-memory conversion separately """
+    log_writer = LogWriter(lambda message: None)
+    generator = IIFGenerator(iif_filename, log_writer)
+    results = {}
+
+    def record(stage, start, items):
+        elapsed = time.time() - start
+        results[stage] = {'seconds': elapsed, 'items': items,
+                          'items_per_second': items / elapsed if elapsed else None,
+                          'peak_rss_kb': peak_memory()}
+
+    start = time.time()
+    transactions = FileParser(filename, log_writer).parse_file()
+    record('parse_file', start, len(transactions))
+
+    start = time.time()
+    groups = list(group_transactions(transactions, count_transactions(transactions)))
+    record('group', start, len(transactions))
+
+    start = time.time()
+    deciphered = []
+    failures = 0
+    for transId, rows in groups:
+        try:
+            deciphered.append(generator.decipher_transactions(rows))
+        except (ParseError, NotImplementedError, VoidError), e:
+            failures += 1
+    record('decipher', start, len(groups))
+    results['decipher']['failures'] = failures
+
+    start = time.time()
+    with open(iif_filename, 'w') as f:
+        f.write(generator.file_start_tpl)
+        for trans, splits in deciphered:
+            generator.write_transaction(trans, splits, f)
+    record('write', start, len(deciphered))
+
+    return results
+
+def time_streaming(filename, iif_filename, max_rows=DEFAULT_MAX_ROWS):
+    """ Time a whole streaming conversion """
+    log_writer = LogWriter(lambda message: None)
+    counted = [0]
+
+    def counting(groups):
+        for group in groups:
+            counted[0] += 1
+            yield group
+
+    start = time.time()
+    groups = FileParser(filename, log_writer).iter_groups(max_rows)
+    IIFGenerator(iif_filename, log_writer).write_groups(counting(groups))
+    elapsed = time.time() - start
+    return {'streaming': {'seconds': elapsed, 'items': counted[0], 'items_per_second': counted[0] / elapsed,
+                          'peak_rss_kb': peak_memory(), 'max_rows': max_rows}}
+
+def time_cache(filename):
+    """ Time parsing the export, then parsing it into an empty parse cache, then reading it back """
+    log_writer = LogWriter(lambda message: None)
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for stage in ('parse_file', 'cache_miss', 'cache_hit'):
+            cache = ParseCache(directory) if stage != 'parse_file' else None
+            start = time.time()
+            rows = len(FileParser(filename, log_writer, cache=cache).parse_file())
+            elapsed = time.time() - start
+            results[stage] = {'seconds': elapsed, 'items': rows, 'items_per_second': rows / elapsed}
+        results['cache_hit']['entry_bytes'] = sum([ os.path.getsize(os.path.join(directory, name))
+                                                    for name in os.listdir(directory) ])
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def time_checkpoints(filename, iif_filename, intervals, max_rows=DEFAULT_MAX_ROWS):
+    """ Time a streaming conversion, then conversions saving a checkpoint every
+    interval rows, which must write the same iif file """
+    log_writer = LogWriter(lambda message: None)
+    results = {}
+    expected = baseline = None
+    for interval in [None] + intervals:
+        generator = IIFGenerator(iif_filename, log_writer)
+        parser = FileParser(filename, log_writer)
+        start = time.time()
+        if interval is None:
+            generator.generate_streaming(parser, max_rows)
+        else:
+            checkpoint = Checkpoint(get_checkpoint_filename(iif_filename), interval)
+            generator.generate_checkpointed(parser, checkpoint, max_rows)
+        elapsed = time.time() - start
+
+        with open(iif_filename) as f:
+            output = f.read()
+        if expected is None:
+            baseline, expected = elapsed, output
+        elif output != expected:
+            raise AssertionError('output with a checkpoint every %d rows differs from the streaming output' % interval)
+
+        stage = 'checkpoint_%s' % (interval or 'none')
+        results[stage] = {'seconds': elapsed, 'items': interval or 0, 'overhead': elapsed / baseline - 1,
+                          'checkpoints': checkpoint.saves if interval else 0,
+                          'checkpoint_seconds': checkpoint.seconds if interval else 0.0}
+    return results
+
+def run_child(queue, function, args):
+    queue.put(function(*args))
+
+def run_isolated(function, *args):
+    """ Run function in a fresh process so its peak memory is its own """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_child, args=(queue, function, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def bench_scaling(filename, max_processes, out=sys.stdout):
+    """ Time the decipher and write stage with 1 to max_processes workers """
+    log_writer = LogWriter(lambda message: None)
+    transactions = FileParser(filename, log_writer).parse_file()
+    groups = list(group_transactions(transactions, count_transactions(transactions)))
+
+    out.write('%d rows, %d groups, %d cpus\n' % (len(transactions), len(groups), multiprocessing.cpu_count()))
+    out.write('processes\tseconds\tgroups/s\tspeedup\n')
+
+    results = {}
+    baseline = expected = None
+    for processes in xrange(1, max_processes + 1):
+        iif_filename = filename + '.%d.iif' % processes
+        start = time.time()
+        IIFGenerator(iif_filename, log_writer).write_groups(groups, processes)
+        elapsed = time.time() - start
+
+        with open(iif_filename) as f:
+            output = f.read()
+        if expected is None:
+            baseline, expected = elapsed, output
+        elif output != expected:
+            raise AssertionError('output with %d processes differs from the serial output' % processes)
+
+        out.write('%d\t%.2f\t%.0f\t%.2f\n' % (processes, elapsed, len(groups) / elapsed, baseline / elapsed))
+        results['write_groups_%d' % processes] = {'seconds': elapsed, 'items': len(groups),
+                                                  'items_per_second': len(groups) / elapsed}
+    return results
+
+
+def run_suite(options, out=sys.stdout):
+    """ Run the chosen suites for every size and layout, returning the results as a dict """
+    report = {'label': options.label, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(), 'seed': options.seed, 'runs': []}
+
+    directory = options.keep or tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        for rows in options.rows:
+            for layout in options.layouts:
+                filename = os.path.join(directory, 'export-%s-%s.csv' % (layout, rows))
+                if not os.path.exists(filename):
+                    write_export(filename, rows, layout, options.seed)
+                iif_filename = filename[:-4] + '.iif'
+
+                run = {'rows': rows, 'layout': layout, 'bytes': os.path.getsize(filename), 'stages': {}}
+                if 'stages' in options.suites:
+                    run['stages'].update(run_isolated(time_stages, filename, iif_filename))
+                if 'streaming' in options.suites:
+                    run['stages'].update(run_isolated(time_streaming, filename, iif_filename, options.max_rows))
+                if 'cache' in options.suites:
+                    run['stages'].update(run_isolated(time_cache, filename))
+                if 'checkpoint' in options.suites:
+                    run['stages'].update(time_checkpoints(filename, iif_filename, options.checkpoint_rows, options.max_rows))
+                if 'scaling' in options.suites:
+                    run['stages'].update(bench_scaling(filename, options.processes, out))
+                report['runs'].append(run)
+
+                for stage, result in sorted(run['stages'].iteritems()):
+                    out.write('%s\t%s\t%s\t%.3fs\t%s KB\n' % (rows, layout, stage, result['seconds'],
+                                                              result.get('peak_rss_kb') or ''))
+    finally:
+        if not options.keep:
+            shutil.rmtree(directory)
+    return report
+
+def compare(old, new, out=sys.stdout):
+    """ Print the change in time and memory of every stage found in both reports """
+    oldRuns = dict(((run['rows'], run['layout']), run) for run in old['runs'])
+    out.write('rows\tlayout\tstage\told s\tnew s\tratio\told KB\tnew KB\n')
+    for run in new['runs']:
+        oldRun = oldRuns.get((run['rows'], run['layout']))
+        if oldRun is None:
+            continue
+        for stage, result in sorted(run['stages'].iteritems()):
+            oldResult = oldRun['stages'].get(stage)
+            if oldResult is None:
+                continue
+            out.write('%s\t%s\t%s\t%.3f\t%.3f\t%.2f\t%s\t%s\n' % (
+                run['rows'], run['layout'], stage, oldResult['seconds'], result['seconds'],
+                result['seconds'] / oldResult['seconds'] if oldResult['seconds'] else 0,
+                oldResult.get('peak_rss_kb') or '', result.get('peak_rss_kb') or ''))
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--rows', default='10000,100000',
+                      help='comma separated sizes of the synthetic exports in rows (default: %default)')
+    parser.add_option('-l', '--layout', default='debitcredit,amount',
+                      help='comma separated column layouts: debitcredit, amount (default: %default)')
+    parser.add_option('-s', '--suite', default='stages,streaming',
+                      help='comma separated suites to run: stages, streaming, cache, checkpoint, scaling (default: %default)')
+    parser.add_option('-p', '--processes', type='int', default=multiprocessing.cpu_count(),
+                      help='largest number of worker processes timed by the scaling suite (default: %default)')
+    parser.add_option('--max-rows', type='int', default=DEFAULT_MAX_ROWS,
+                      help='rows held in memory by the streaming suite (default: %default)')
+    parser.add_option('--checkpoint-rows', default='10000,100000',
+                      help='comma separated intervals in rows timed by the checkpoint suite (default: %default)')
+    parser.add_option('--seed', type='int', default=0, help='seed of the synthetic exports (default: %default)')
+    parser.add_option('--label', default='', help='name stored with the results, e.g. a version')
+    parser.add_option('-o', '--output', help='write the results to this json file')
+    parser.add_option('-c', '--compare', help='compare the results with an earlier json file')
+    parser.add_option('-k', '--keep', help='write the synthetic exports to this directory and reuse them')
+    parser.add_option('-g', '--generate', help='only write a synthetic export of the first size to this file')
+    options, args = parser.parse_args(argv)
+
+    options.rows = [ int(rows) for rows in options.rows.split(',') ]
+    options.layouts = options.layout.split(',')
+    options.suites = options.suite.split(',')
+    options.checkpoint_rows = [ int(rows) for rows in options.checkpoint_rows.split(',') ]
+
+    if options.generate:
+        write_export(options.generate, options.rows[0], options.layouts[0], options.seed)
+        return 0
+
+    report = run_suite(options)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,7 +2,42 @@
 
 from __future__ import with_statement
 from decimal import Decimal, InvalidOperation
-import sys, os, collections, Tkinter, tkFileDialog, csv
+import sys, os, collections, csv, tempfile, cPickle, cStringIO, optparse, time, heapq, json, hashlib, mmap, re, bisect, threading, Queue, itertools, operator, fnmatch, gzip, bz2, io, array, struct, marshal, shutil
+
+# maximum number of rows held in memory by the streaming converter before
+# open transaction groups are spilled to disk
+DEFAULT_MAX_ROWS = 100000
+
+# number of transaction groups handed to a worker process at a time
+DEFAULT_CHUNK_SIZE = 2000
+
+# smallest piece of the input file parsed by one worker process
+DEFAULT_MIN_CHUNK_BYTES = 1 << 20
+
+# bytes of iif text collected before they are written out
+DEFAULT_BUFFER_SIZE = 1 << 18
+
+# the first bytes of each supported compressed file format, and its extension
+COMPRESSION_MAGIC = [('gz', '\x1f\x8b'), ('bz2', 'BZh'), ('xz', '\xfd7zXZ\x00')]
+COMPRESSION_EXTENSIONS = {'gz': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+# total size of a parse cache directory beyond which the least recently used
+# entries are removed, and the first bytes of an entry with its format version
+DEFAULT_CACHE_SIZE = 1 << 30
+CACHE_MAGIC = 'qbexport parse cache 1\n'
+
+# rows read between the checkpoints of a resumable conversion
+DEFAULT_CHECKPOINT_ROWS = 100000
+
+# rows or transaction groups between progress updates of a gui conversion
+DEFAULT_PROGRESS_INTERVAL = 1000
+
+# milliseconds between checks of the gui for progress updates
+POLL_INTERVAL = 100
+
+# start of a line whose first column is not empty: an account header or total,
+# or a line inside a quoted field, which the quote count tells apart
+ACCOUNT_LINE = re.compile(r'^[^,\n]', re.M)
 
 
 class LogWriter(object):
@@ -13,13 +48,34 @@ class LogWriter(object):
         for log in self.logs:
             log(message)
 
+    def close(self):
+        """ Close the logs that are files, which completes compressed ones """
+        for log in self.logs:
+            close = getattr(log, 'close', None)
+            if close is not None:
+                close()
+
 class MessageWindow(object):
-    """ Displays error messages using tkinter """
-    def __init__(self):
+    """ Displays error messages using tkinter.  Given a cancel function the
+    window also shows the progress of a conversion and a Cancel button """
+    def __init__(self, cancel=None):
+        import Tkinter
 
         # set up messages window
         Tkinter.Label(text='Messages:').pack()
 
+        # add progress bar, status line and cancel button below the messages
+        if cancel is not None:
+            import ttk
+            frame = Tkinter.Frame()
+            frame.pack(side=Tkinter.BOTTOM, fill=Tkinter.X)
+            self.button = Tkinter.Button(frame, text='Cancel', command=cancel)
+            self.button.pack(side=Tkinter.RIGHT)
+            self.bar = ttk.Progressbar(frame, orient=Tkinter.HORIZONTAL, mode='indeterminate')
+            self.bar.pack(side=Tkinter.TOP, fill=Tkinter.X, expand=True)
+            self.status = Tkinter.Label(frame, anchor=Tkinter.W)
+            self.status.pack(side=Tkinter.TOP, fill=Tkinter.X)
+
         # add right scrollbar
         s = Tkinter.Scrollbar()
         s.pack(side=Tkinter.RIGHT, fill=Tkinter.Y)
@@ -41,37 +97,393 @@ class MessageWindow(object):
         self.lbox = lbox
 
     def insert(self, text):
+        import Tkinter
         self.lbox.insert(Tkinter.END, text)
+        self.lbox.see(Tkinter.END)
+
+    def update_progress(self, rows, groups, failures, total):
+        self.status.config(text='%s rows parsed, %s transactions written, %s failed' % (rows, groups, failures))
+        if total is None:
+            # the number of transactions is not known until the file has been read
+            self.bar.step()
+        else:
+            self.bar.config(mode='determinate', maximum=max(total, 1), value=groups)
+
+    def update_counting(self, lines):
+        self.status.config(text='%s lines read counting the transactions' % lines)
+        self.bar.step()
+
+    def finish(self):
+        self.bar.stop()
+        self.bar.config(mode='determinate', maximum=1, value=1)
+        self.button.config(text='Close', command=self.lbox.quit)
+
+    def poll(self, updates):
+        """ Show the messages and progress a conversion thread has put on the
+        updates queue, checking again every POLL_INTERVAL ms until it is done """
+        try:
+            while True:
+                kind, value = updates.get_nowait()
+                if kind == 'message':
+                    self.insert(value)
+                elif kind == 'progress':
+                    self.update_progress(*value)
+                elif kind == 'counting':
+                    self.update_counting(value)
+                elif kind == 'done':
+                    self.finish()
+                    return
+        except Queue.Empty:
+            pass
+        self.lbox.after(POLL_INTERVAL, self.poll, updates)
 
     def show(self):
+        import Tkinter
         Tkinter.mainloop()
 
 class UI(object):
     def __init__(self):
+        import Tkinter
 
         # start tk and ask it to not show a window
         self.root = Tkinter.Tk()
         self.root.withdraw()
 
     def get_filename(self):
+        import tkFileDialog
         filename = tkFileDialog.askopenfilename(filetypes=[('Quickbooks Export', '*.csv')])
         self.root.deiconify()
         return filename
 
-# Make the ui a singleton object
-UI = UI()
+_ui = None
+
+def get_ui():
+    """ Return the ui singleton, only starting tk the first time it is needed """
+    global _ui
+    if _ui is None:
+        _ui = UI()
+    return _ui
+
+class Transaction(tuple):
+    """ A parsed data row, keeping only the columns the converter uses.
+
+    Values are looked up by column name just like the maps the parser used
+    to build, but the row is a plain tuple and the account path is shared
+    with every other row under the same account header.
+    """
+    __slots__ = ()
+
+    columns = ('AccountName', 'Trans #', 'Type', 'Split', 'Date', 'Name', 'Memo', 'Num', 'Amount')
+    index = dict((column, i) for i, column in enumerate(columns))
+
+    def __new__(cls, values):
+        return tuple.__new__(cls, values)
+
+    def __getnewargs__(self):
+        return (tuple(self),)
+
+    def __getitem__(self, column):
+        return tuple.__getitem__(self, self.index[column])
+
+    def get(self, column, default=None):
+        if column in self.index:
+            return self[column]
+        return default
+
+    def keys(self):
+        return list(self.columns)
+
+    def iteritems(self):
+        return iter(zip(self.columns, self))
+
+    def replace(self, **changes):
+        """ Return a copy of the row with some of its columns changed """
+        values = list(self)
+        for column, value in changes.iteritems():
+            values[self.index[column]] = value
+        return Transaction(values)
+
+    def __repr__(self):
+        return 'Transaction(%r)' % dict(self.iteritems())
+
+def copy_row(row, **changes):
+    """ Copy a parsed row (a Transaction or a map) with some columns changed """
+    if isinstance(row, Transaction):
+        return row.replace(**changes)
+    new = dict(row)
+    new.update(changes)
+    return new
+
+
+ZERO = Decimal(0)
+
+def parse_cents(value):
+    """ Return a plain two decimal currency string such as '-1234.50' as
+    integer cents, or None if it needs the full Decimal parser """
+    if len(value) > 3 and value[-3] == '.':
+        whole, fraction = value[:-3], value[-2:]
+        if fraction.isdigit():
+            if whole.isdigit():
+                return int(whole + fraction)
+            # '-0.00' is left to Decimal so that the sign of zero is kept
+            if whole[:1] == '-' and whole[1:].isdigit():
+                cents = int(whole + fraction)
+                if cents:
+                    return cents
+    return None
+
+def is_cents(amount):
+    return amount.__class__ is int or amount.__class__ is long
+
+def to_decimal(amount):
+    """ Return an amount held as integer cents or as a Decimal as a Decimal """
+    if is_cents(amount):
+        return Decimal(amount).scaleb(-2)
+    return Decimal(amount)
+
+def sum_amounts(amounts):
+    """ Sum amounts, staying in integer cents unless one of them is a Decimal """
+    cents = 0
+    decimals = None
+    for amount in amounts:
+        # is_cents, inlined since this runs for every split
+        if amount.__class__ is int or amount.__class__ is long:
+            cents += amount
+        elif decimals is None:
+            decimals = amount
+        else:
+            decimals += amount
+
+    if decimals is None:
+        return cents
+    return decimals + to_decimal(cents)
+
+def amounts_equal(first, second):
+    """ Compare two amounts that may be held in different representations """
+    if is_cents(first) == is_cents(second):
+        return first == second
+    return to_decimal(first) == to_decimal(second)
+
+def format_amount(amount):
+    """ Return the text written to the iif file for an amount, the same text
+    the amount's Decimal would give """
+    if is_cents(amount):
+        if amount < 0:
+            return '-%d.%02d' % divmod(-amount, 100)
+        return '%d.%02d' % divmod(amount, 100)
+    return amount
+
 
 class ParseError(Exception): pass
 class NotImplementedError(Exception): pass
 class VoidError(Exception): pass
+# a group that moves money but has no single row that could be the transaction
+class AmbiguousError(VoidError): pass
 class ColumnsInvalidError(Exception): pass
+class Cancelled(Exception): pass
+
+
+class ConversionStats(object):
+    """ Optional instrumentation of a conversion.  Records the wall time and
+    throughput of each stage, counters, failures by exception class and the
+    groups with the most splits. """
+
+    # stages in the order they are reported
+    stages = ('count', 'csv read', 'get_data_row', 'grouping', 'decipher', 'write', 'render')
+
+    def __init__(self, largest=10):
+        self.seconds = collections.defaultdict(float)
+        self.items = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self.failures = collections.defaultdict(int)
+        self.largest = []   # a heap of (splits, Trans #)
+        self.keep = largest
+
+    def add(self, stage, seconds, items):
+        self.seconds[stage] += seconds
+        self.items[stage] += items
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def failure(self, e):
+        self.failures[e.__class__.__name__] += 1
+
+    def group(self, transId, splits):
+        """ Remember a written group if it is one of the largest seen """
+        if len(self.largest) < self.keep:
+            heapq.heappush(self.largest, (splits, transId))
+        elif splits > self.largest[0][0]:
+            heapq.heapreplace(self.largest, (splits, transId))
+
+    def as_dict(self):
+        stages = {}
+        for stage, seconds in self.seconds.iteritems():
+            stages[stage] = {'seconds': seconds, 'items': self.items[stage],
+                             'per_second': self.items[stage] / seconds if seconds else None}
+        return {'stages': stages, 'counters': dict(self.counters), 'failures': dict(self.failures),
+                'largest_groups': [ {'trans': transId, 'splits': splits}
+                                    for splits, transId in sorted(self.largest, reverse=True) ]}
+
+    def report(self, log_writer):
+        """ Write the statistics to the log, one line per message """
+        known = [ stage for stage in self.stages if stage in self.seconds ]
+        for stage in known + sorted(set(self.seconds) - set(known)):
+            seconds, items = self.seconds[stage], self.items[stage]
+            rate = ' (%.0f/s)' % (items / seconds) if seconds else ''
+            log_writer.write('Statistics: %s took %.3fs for %s items%s' % (stage, seconds, items, rate))
+        if self.counters:
+            log_writer.write('Statistics: %s' % ', '.join('%s %s' % (counter, n) for counter, n in sorted(self.counters.iteritems())))
+        if self.failures:
+            log_writer.write('Statistics: failures %s' % ', '.join('%s %s' % (name, n) for name, n in sorted(self.failures.iteritems())))
+        if self.largest:
+            log_writer.write('Statistics: largest groups by split count %s' %
+                             ', '.join('%s (%s)' % (transId, splits) for splits, transId in sorted(self.largest, reverse=True)))
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+class ConversionProgress(object):
+    """ Reports the progress of a conversion running on a background thread.
+
+    Every interval rows or transaction groups the counts are put on the
+    updates queue as ('progress', (rows, groups, failures, total groups)),
+    and once cancel has been called the conversion raises Cancelled at the
+    next update.  While the transactions are counted, before any row is
+    parsed, ('counting', lines) is put every interval lines instead.
+    """
+    def __init__(self, updates, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.updates = updates
+        self.interval = interval
+        self.cancelled = threading.Event()
+        self.rows = 0
+        self.groups = 0
+        self.failures = 0
+        self.total = None
+        self.result = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def update(self):
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.updates.put(('progress', (self.rows, self.groups, self.failures, self.total)))
+
+    def message(self, message):
+        """ A log function passing messages on to the gui thread """
+        self.updates.put(('message', message))
+
+    def failure(self):
+        self.failures += 1
+
+    def iter_rows(self, rows):
+        for row in rows:
+            self.rows += 1
+            if not self.rows % self.interval:
+                self.update()
+            yield row
+        self.update()
+
+    def iter_groups(self, groups):
+        for group in groups:
+            self.groups += 1
+            if not self.groups % self.interval:
+                self.update()
+            yield group
+        self.update()
+
+    def iter_counting(self, lines):
+        counted = 0
+        for line in lines:
+            counted += 1
+            if not counted % self.interval:
+                if self.cancelled.is_set():
+                    raise Cancelled()
+                self.updates.put(('counting', counted))
+            yield line
+
+
+def parse_date(value):
+    """ Return a date of the export (m/d/yyyy) or of the command line
+    (yyyy-mm-dd) as a (year, month, day) tuple, or None if it is not one """
+    try:
+        if '-' in value:
+            year, month, day = value.split('-')
+        else:
+            month, day, year = value.split('/')
+        return int(year), int(month), int(day)
+    except ValueError:
+        return None
+
+class RowFilter(object):
+    """ Chooses the rows a FileParser builds records for.
+
+    An account matches a pattern if its path joined with ':' matches it as
+    a glob, or is it or one of its subaccounts.  A row is kept if its account
+    matches one of accounts (when any are given) and none of
+    exclude_accounts, its date is between start and end inclusive, and its
+    type is one of types (when any are given) and not one of exclude_types.
+    """
+    def __init__(self, accounts=(), exclude_accounts=(), start=None, end=None, types=(), exclude_types=()):
+        self.accounts = list(accounts)
+        self.exclude_accounts = list(exclude_accounts)
+        self.start = parse_date(start) if start else None
+        self.end = parse_date(end) if end else None
+        for value, day in ((start, self.start), (end, self.end)):
+            if value and (day is None or not (1 <= day[1] <= 12 and 1 <= day[2] <= 31)):
+                raise ValueError('dates must be given as yyyy-mm-dd or m/d/yyyy, not %s' % value)
+        self.types = set(types)
+        self.exclude_types = set(exclude_types)
+        self.checks_rows = bool(self.start or self.end or self.types or self.exclude_types)
+        self.decisions = {}  # account path -> whether its rows are kept
+
+    def account_matches(self, name, patterns):
+        for pattern in patterns:
+            if name == pattern or name.startswith(pattern + ':') or fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def account_included(self, path):
+        included = self.decisions.get(path)
+        if included is None:
+            name = ':'.join(path)
+            included = ((not self.accounts or self.account_matches(name, self.accounts))
+                        and not self.account_matches(name, self.exclude_accounts))
+            self.decisions[path] = included
+        return included
+
+    def row_included(self, tType, date):
+        if (self.types and tType not in self.types) or tType in self.exclude_types:
+            return False
+        if self.start or self.end:
+            day = parse_date(date)
+            if day is None or (self.start and day < self.start) or (self.end and day > self.end):
+                return False
+        return True
 
 
 class FileParser(object):
-    def __init__(self, filename, log_writer):
+    def __init__(self, filename, log_writer, stats=None, processes=None, row_filter=None, cache=None):
         self.filename = filename
         self.log_writer = log_writer
+        self.stats = stats
+        self.processes = processes  # parse with a pool of this many processes if more than one
+        self.progress = None
+        self.row_filter = row_filter
+        self.row_check = row_filter.row_included if row_filter is not None and row_filter.checks_rows else None
+        self.cache = cache       # a ParseCache to read the parsed rows from instead of the csv
+        self.cached = None       # the CachedExport read from the cache
+        self.reading = None      # the file, csv reader and first line number of iter_rows_from
+        self.headerCount = 0     # account headers seen by the current parse
         self.currentAccount = [] # a stack, keeps track of the current account while parsing
+        self.accountPath = ()    # the current account as a shared tuple
+        self.accountPaths = collections.OrderedDict()  # interned account paths, in the order the file opens them
+        self.skipping = False    # whether the rows of the current account are filtered out
+        self.accounts = None     # account path -> data rows directly under it, from count_groups
+        self.layout = None       # column positions for the last header seen
+        self.layoutColumns = None
 
     def get_decimal(self, value):
         """ Return a decimal value from a string """
@@ -81,6 +493,16 @@ class FileParser(object):
             amount = Decimal(0)
         return amount
 
+    def get_amount(self, value):
+        """ Return an amount as integer cents if it is plain currency, or as a Decimal if not """
+        cents = parse_cents(value)
+        if cents is None:
+            # blank cells fill half of the Debit/Credit layout, so don't make get_decimal raise for them
+            if not value:
+                return ZERO
+            return self.get_decimal(value)
+        return cents
+
     def check_columns(self, columnArray):
         """ Check that all needed columns of data are available """
         for column in ('AccountName', 'Trans #', 'Type', 'Split', 'Date', 'Name', 'Memo'):
@@ -90,8 +512,30 @@ class FileParser(object):
         if 'Amount' not in columnArray and ('Debit' not in columnArray or 'Credit' not in columnArray):
             raise ColumnsInvalidError('The necessary column "Amount" was not found in the input file')
 
+    def intern_account(self):
+        """ Return the current account stack as a tuple shared by every row under it """
+        path = tuple(self.currentAccount)
+        return self.accountPaths.setdefault(path, path)
+
+    def update_account(self):
+        """ Start a new account section after the account stack has changed """
+        self.accountPath = self.intern_account()
+        if self.row_filter is not None:
+            self.skipping = not self.row_filter.account_included(self.accountPath)
+
+    def get_layout(self, columnArray):
+        """ Find the positions of the columns a Transaction is built from """
+        positions = dict((column, i) for i, column in enumerate(columnArray))
+        layout = [ positions.get(column) for column in ('Trans #', 'Type', 'Split', 'Date', 'Name', 'Memo', 'Num') ]
+
+        if 'Credit' in positions and 'Debit' in positions:
+            layout.extend((positions['Debit'], positions['Credit']))
+        else:
+            layout.extend((positions['Amount'], None))
+        return layout
+
     def get_data_row(self, line, columnArray):
-        """ Parse a row of the quickbooks data and return the result as a map """
+        """ Parse a row of the quickbooks data and return the result as a Transaction """
 
         # if this is a row specifying the account then push or pop the account
         if line[0]:
@@ -101,55 +545,945 @@ class FileParser(object):
                 return None
             else:
                 self.currentAccount.append(line[0])
+                self.headerCount += 1
+            self.update_account()
+            return None
+
+        # no records are built for the rows of a filtered out account
+        if self.skipping:
+            return None
+
+        # the column positions only change when the header does
+        if columnArray is not self.layoutColumns:
+            self.layout = self.get_layout(columnArray)
+            self.layoutColumns = columnArray
+        transId, tType, split, date, name, memo, num, debit, credit = self.layout
+
+        if self.row_check is not None and not self.row_check(line[tType], line[date]):
             return None
+
+        # Fix data being read
+        if credit is not None:
+            credit = -self.get_amount(line[credit])
+            amount = credit if credit else self.get_amount(line[debit])
         else:
-            # make a map
-            new = {}
-            for i, data in enumerate(line):
-                new[columnArray[i]] = data
-
-            # Fix data being read
-            if 'Credit' in columnArray and 'Debit' in columnArray:
-                credit = -self.get_decimal(new['Credit'])
-                debit = self.get_decimal(new['Debit'])
-                new['Amount'] = credit if credit else debit
-            else:
-                new['Amount'] = self.get_decimal(new['Amount'])
+            amount = self.get_amount(line[debit])
 
-            new['AccountName'] = list(self.currentAccount)
-        return new
+        return Transaction((self.accountPath, line[transId], line[tType], line[split], line[date],
+                            line[name], line[memo], line[num] if num is not None else '', amount))
 
-    def parse_file(self):
-        """ Read a csv file and parse the data into a list """
-        transactions = []
+    def read_header(self, reader):
+        """ Read and check the header columns of a csv reader """
+        columnArray = reader.next()
+        columnArray[0] = 'AccountName'
+
+        # check to make sure we have all the needed columns
+        try:
+            self.check_columns(columnArray)
+        except ColumnsInvalidError, e:
+            self.log_writer.write(e)
+            raise ParseError()
+
+        return columnArray
+
+    def iter_rows(self):
+        """ Read a csv file and yield each data row as it is parsed """
+        # a compressed file can't be memory mapped, so it is always read from start to end
+        if self.cache is not None:
+            rows = self.cached_export().iter_rows(self.row_filter)
+        elif self.processes > 1 and get_compression(self.filename) is None:
+            rows = self.iter_rows_parallel(self.processes)
+        else:
+            rows = self.iter_rows_serial()
+        if self.progress is not None:
+            rows = self.progress.iter_rows(rows)
+        return rows
 
-        with open(self.filename) as f:
+    def cached_export(self):
+        """ Return the parsed rows of the file from the cache, parsing them into it if needed """
+        if self.cached is None:
+            self.cached = self.cache.load(self.filename, self.log_writer, self.stats, self.processes)
+        return self.cached
 
-            reader = csv.reader(f)
+    def iter_rows_serial(self):
+        """ Read a csv file from start to end, yielding each data row """
+        self.currentAccount = []
+        self.update_account()
+        self.headerCount = 0
 
-            # parse header columns
-            columnArray = reader.next()
-            columnArray[0] = 'AccountName'
+        with open_input(self.filename) as f:
+
+            reader = csv.reader(f)
+            columnArray = self.read_header(reader)
 
-            # check to make sure we have all the needed columns
             try:
-                self.check_columns(columnArray)
-            except ColumnsInvalidError, e:
-                self.log_writer.write(e)
+                if self.stats is None:
+                    # loop through data
+                    for line in reader:
+                        transaction = self.get_data_row(line, columnArray)
+                        if transaction is not None:
+                            yield transaction
+                else:
+                    for transaction in self.iter_rows_timed(reader, columnArray):
+                        yield transaction
+            except csv.Error, e:
+                self.log_writer.write('Could not parse file (line number %s)' % reader.line_num)
                 raise ParseError()
 
-            transaction = []
+    def iter_rows_from(self, position=None):
+        """ Read an uncompressed csv file from start to end like
+        iter_rows_serial, or continue from a position an earlier read had
+        reached.  Between rows, position() tells where the read has got to. """
+        self.currentAccount = list(position[1]) if position is not None else []
+        self.update_account()
+
+        with open_input(self.filename) as f:
+            # readline, unlike iterating over the file, reads no further than the
+            # line it returns, so the offset of the file is exact between rows
+            reader = csv.reader(iter(f.readline, ''))
+            columnArray = self.read_header(reader)
+            lineBase = 0
+            if position is not None:
+                f.seek(position[0])
+                lineBase = position[2] - reader.line_num
+
+            self.reading = (f, reader, lineBase)
             try:
-                # loop through data
                 for line in reader:
                     transaction = self.get_data_row(line, columnArray)
                     if transaction is not None:
-                        transactions.append(transaction)
+                        yield transaction
+            except csv.Error, e:
+                self.log_writer.write('Could not parse file (line number %s)' % (lineBase + reader.line_num))
+                raise ParseError()
+            finally:
+                self.reading = None
+
+    def position(self):
+        """ The byte offset, account stack and line number iter_rows_from has reached """
+        f, reader, lineBase = self.reading
+        return f.tell(), tuple(self.currentAccount), lineBase + reader.line_num
+
+    def iter_rows_timed(self, reader, columnArray):
+        """ The loop of iter_rows, timing csv reading and get_data_row separately """
+        clock = time.time
+        reading = parsing = 0.0
+        lines = rows = 0
+        try:
+            while True:
+                start = clock()
+                try:
+                    line = reader.next()
+                except StopIteration:
+                    break
+                middle = clock()
+                transaction = self.get_data_row(line, columnArray)
+                parsing += clock() - middle
+                reading += middle - start
+
+                lines += 1
+                if transaction is not None:
+                    rows += 1
+                    yield transaction
+        finally:
+            self.stats.add('csv read', reading, lines)
+            self.stats.add('get_data_row', parsing, lines)
+            self.stats.count('rows', rows)
+            self.stats.count('account headers', self.headerCount)
+
+    def iter_rows_parallel(self, processes, min_chunk_bytes=DEFAULT_MIN_CHUNK_BYTES):
+        """ Parse a memory mapped csv file in chunks on a pool of worker processes.
+
+        A quick first pass finds the account headers and totals, and the
+        account stack in effect at the start of each chunk, so every chunk
+        can be parsed on its own.  The rows are yielded in file order and are
+        the same rows iter_rows_serial would give. """
+        self.currentAccount = []
+        self.update_account()
+        start = time.time()
+        rows = 0
+
+        with open(self.filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                headerEnd = record_end(mm, 0)
+                columnArray = self.read_header(csv.reader(cStringIO.StringIO(mm[:headerEnd])))
+                chunks = self.plan_chunks(mm, headerEnd, processes * 4, min_chunk_bytes, columnArray)
+            finally:
+                mm.close()
+
+        jobs = [ (self.filename, chunkStart, chunkEnd, stack, lineNumber, columnArray, self.row_filter)
+                 for chunkStart, chunkEnd, stack, lineNumber in chunks ]
+        for chunkRows, errorLine in imap_ordered(processes, parse_chunk, jobs):
+            if errorLine is not None:
+                self.log_writer.write('Could not parse file (line number %s)' % errorLine)
+                raise ParseError()
+            rows += len(chunkRows)
+            for values in chunkRows:
+                yield Transaction(values)
+
+        if self.stats is not None:
+            self.stats.add('parallel parse', time.time() - start, rows)
+            self.stats.count('rows', rows)
+
+    def plan_chunks(self, mm, start, count, min_chunk_bytes, columnArray):
+        """ Split mm from start into about count chunks that end on record
+        boundaries.  Returns (start, end, account stack, lines before start)
+        for each chunk. """
+        # find the account headers and totals, and the stack after each of them
+        headerEnds = []
+        stacks = []
+        quotes = 0
+        cursor = start
+        for match in ACCOUNT_LINE.finditer(mm, start):
+            position = match.start()
+            quotes += mm[cursor:position].count('"')
+            cursor = position
+            if quotes % 2:
+                # this line is part of a quoted field that spans lines
+                continue
+
+            end = record_end(mm, position)
+            line = csv.reader(cStringIO.StringIO(mm[position:end])).next()
+            if line and line[0]:
+                self.get_data_row(line, columnArray)
+                headerEnds.append(end)
+                stacks.append(tuple(self.currentAccount))
+
+        # cut the file into chunks of about the same size, each starting at a record
+        size = len(mm)
+        chunkBytes = max(min_chunk_bytes, (size - start) // count + 1)
+        boundaries = [start]
+        lines = [mm[:start].count('\n')]
+        while boundaries[-1] < size:
+            target = min(boundaries[-1] + chunkBytes, size)
+            boundary = record_end(mm, target, mm[boundaries[-1]:target].count('"'))
+            lines.append(lines[-1] + mm[boundaries[-1]:boundary].count('\n'))
+            boundaries.append(boundary)
+
+        chunks = []
+        for i in xrange(len(boundaries) - 1):
+            header = bisect.bisect_right(headerEnds, boundaries[i])
+            stack = stacks[header - 1] if header else ()
+            chunks.append((boundaries[i], boundaries[i + 1], stack, lines[i]))
+        return chunks
+
+    def parse_file(self):
+        """ Read a csv file and parse the data into a list """
+        return list(self.iter_rows())
+
+    def count_groups(self):
+        """ Count the rows belonging to each Trans # without parsing them.
+        The same pass fills in the account index, see account_index. """
+        if self.cache is not None:
+            counts, self.accounts = self.cached_export().count_groups(self.row_filter)
+            return counts
+
+        counts = collections.defaultdict(int)
+        accounts = collections.OrderedDict()
+        start = time.time()
+
+        self.currentAccount = []
+        self.update_account()
+
+        with open_input(self.filename) as f:
+
+            reader = csv.reader(f)
+            columnArray = self.read_header(reader)
+            transIndex = columnArray.index('Trans #')
+            typeIndex = columnArray.index('Type')
+            dateIndex = columnArray.index('Date')
+            rowCheck = self.row_check
+            sectionRows = 0
+            lines = reader if self.progress is None else self.progress.iter_counting(reader)
+
+            try:
+                for line in lines:
+                    # account headers and totals are not data rows
+                    if not line[0]:
+                        sectionRows += 1
+                        if self.skipping or (rowCheck is not None and not rowCheck(line[typeIndex], line[dateIndex])):
+                            continue
+                        counts[line[transIndex]] += 1
+                    else:
+                        accounts[self.accountPath] = accounts.get(self.accountPath, 0) + sectionRows
+                        sectionRows = 0
+                        self.get_data_row(line, columnArray)
+                        accounts.setdefault(self.accountPath, 0)
             except csv.Error, e:
                 self.log_writer.write('Could not parse file (line number %s)' % reader.line_num)
                 raise ParseError()
+            accounts[self.accountPath] = accounts.get(self.accountPath, 0) + sectionRows
+
+        if self.stats is not None:
+            self.stats.add('count', time.time() - start, reader.line_num)
+        self.accounts = accounts
+        return counts
+
+    def account_index(self):
+        """ Map every account path, in the order of the file, to the number of
+        data rows directly under it, reading the file once without building
+        any rows.  Rows before the first account header are under (). """
+        if self.accounts is None:
+            self.count_groups()
+        return self.accounts
+
+    def iter_groups(self, max_rows=DEFAULT_MAX_ROWS):
+        """ Stream the file in two passes, yielding each transaction group as soon as it is complete """
+        return group_transactions(self.iter_rows(), self.count_groups(), max_rows, self.stats)
+
+
+def file_fingerprint(filename):
+    """ Return the size, modification time and md5 of the content of a file """
+    digest = hashlib.md5()
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        for block in iter(lambda: f.read(DEFAULT_BUFFER_SIZE), ''):
+            digest.update(block)
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+def index_array(values):
+    """ Return a list of non-negative ints as an array of the smallest type that holds them """
+    largest = max(values) if values else 0
+    for typecode in ('B', 'H', 'I'):
+        if largest >> (8 * array.array(typecode).itemsize) == 0:
+            return array.array(typecode, values)
+    return array.array('L', values)
+
+class CachedExport(object):
+    """ The parsed rows of one export, held column by column.
+
+    The account column indexes the account paths, which are in the order the
+    file opens them, and the text columns index one table of every distinct
+    string in the export.  Amounts are integer cents, except for the few that
+    are Decimals or don't fit in 32 bits, which are kept aside by row.  The
+    group columns give the number of rows of each Trans #.
+    """
+    text_columns = ('Trans #', 'Type', 'Split', 'Date', 'Name', 'Memo', 'Num')
+    array_sections = ('accounts', 'amounts', 'group ids', 'group counts') + text_columns
+    pickled_sections = ('paths', 'strings', 'odd amounts')
+
+    def __init__(self, fingerprint, sections):
+        self.fingerprint = fingerprint
+        self.sections = sections
+        self.paths = sections['paths']
+        self.strings = sections['strings']
+        self.rows = len(sections['accounts'])
+
+    @classmethod
+    def from_rows(cls, fingerprint, rows, accountPaths):
+        """ Build the columns from parsed rows.  accountPaths is the parser's
+        ordered map of interned paths, which holds each path before its rows
+        are yielded. """
+        pathIndex = {}
+        stringIndex = {}
+        intern = stringIndex.setdefault
+        accounts, amounts = [], []
+        texts = [ [] for column in cls.text_columns ]
+        transIds, types, splits, dates, names, memos, nums = [ column.append for column in texts ]
+        oddAmounts = {}
+        lastPath = lastIndex = None
+
+        for row in rows:
+            path, transId, tType, split, date, name, memo, num, amount = row
+            if path is not lastPath:
+                lastIndex = pathIndex.get(path)
+                if lastIndex is None:
+                    pathIndex = dict((known, i) for i, known in enumerate(accountPaths))
+                    lastIndex = pathIndex[path]
+                lastPath = path
+            accounts.append(lastIndex)
+            transIds(intern(transId, len(stringIndex)))
+            types(intern(tType, len(stringIndex)))
+            splits(intern(split, len(stringIndex)))
+            dates(intern(date, len(stringIndex)))
+            names(intern(name, len(stringIndex)))
+            memos(intern(memo, len(stringIndex)))
+            nums(intern(num, len(stringIndex)))
+            if is_cents(amount) and -1 << 31 <= amount < 1 << 31:
+                amounts.append(amount)
+            else:
+                oddAmounts[len(amounts)] = amount
+                amounts.append(0)
+
+        strings = [None] * len(stringIndex)
+        for string, i in stringIndex.iteritems():
+            strings[i] = string
+        groups = collections.defaultdict(int)
+        for transId in texts[0]:
+            groups[transId] += 1
+
+        sections = {'paths': list(accountPaths), 'strings': strings, 'odd amounts': oddAmounts,
+                    'accounts': index_array(accounts), 'amounts': array.array('i', amounts),
+                    'group ids': index_array(groups.keys()), 'group counts': index_array(groups.values())}
+        for column, values in zip(cls.text_columns, texts):
+            sections[column] = index_array(values)
+        return cls(fingerprint, sections)
+
+    def write(self, f):
+        """ Write the entry: the magic, the length of the pickled header, the
+        header, then every section one after the other """
+        blobs = []
+        header = {'fingerprint': self.fingerprint, 'byteorder': sys.byteorder, 'sections': {}}
+        offset = 0
+        for name in self.array_sections + self.pickled_sections:
+            section = self.sections[name]
+            if name in self.pickled_sections:
+                typecode, blob = None, cPickle.dumps(section, cPickle.HIGHEST_PROTOCOL)
+            else:
+                typecode, blob = section.typecode, section.tostring()
+            header['sections'][name] = (typecode, offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+
+        headerBlob = cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL)
+        f.write(CACHE_MAGIC + struct.pack('<Q', len(headerBlob)) + headerBlob)
+        for blob in blobs:
+            f.write(blob)
+
+    @classmethod
+    def read(cls, filename, fingerprint):
+        """ Memory map an entry written by write, returning None if it isn't
+        an entry for an export with this fingerprint """
+        with open(filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = len(CACHE_MAGIC) + 8
+                if mm[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+                    return None
+                headerSize, = struct.unpack('<Q', mm[len(CACHE_MAGIC):start])
+                header = cPickle.loads(mm[start:start + headerSize])
+                if header['fingerprint'] != fingerprint or header['byteorder'] != sys.byteorder:
+                    return None
+
+                # every section is copied out of the map in one piece
+                start += headerSize
+                sections = {}
+                for name, (typecode, offset, size) in header['sections'].iteritems():
+                    blob = mm[start + offset:start + offset + size]
+                    if typecode is None:
+                        sections[name] = cPickle.loads(blob)
+                    else:
+                        sections[name] = array.array(typecode)
+                        sections[name].fromstring(blob)
+            finally:
+                mm.close()
+        return cls(fingerprint, sections)
+
+    def amounts(self):
+        amounts = self.sections['amounts']
+        if not self.sections['odd amounts']:
+            return amounts
+        amounts = list(amounts)
+        for row, amount in self.sections['odd amounts'].iteritems():
+            amounts[row] = amount
+        return amounts
+
+    def selected(self, row_filter):
+        """ Yield whether each row is kept by row_filter """
+        included = [ row_filter.account_included(path) for path in self.paths ]
+        if not row_filter.checks_rows:
+            return itertools.imap(included.__getitem__, self.sections['accounts'])
+        return self.selected_rows(row_filter, included)
+
+    def selected_rows(self, row_filter, included):
+        strings = self.strings
+        decisions = {}  # (type, date) -> whether rows of that type and date are kept
+        for account, tType, date in itertools.izip(self.sections['accounts'], self.sections['Type'], self.sections['Date']):
+            if not included[account]:
+                yield False
+                continue
+            keep = decisions.get((tType, date))
+            if keep is None:
+                keep = decisions[tType, date] = row_filter.row_included(strings[tType], strings[date])
+            yield keep
+
+    def iter_rows(self, row_filter=None):
+        """ Yield the rows as Transactions, as a FileParser with row_filter would """
+        lookup = self.strings.__getitem__
+        columns = [ itertools.imap(self.paths.__getitem__, self.sections['accounts']) ]
+        columns.extend([ itertools.imap(lookup, self.sections[column]) for column in self.text_columns ])
+        columns.append(self.amounts())
+        values = itertools.izip(*columns)
+        if row_filter is not None:
+            values = itertools.compress(values, self.selected(row_filter))
+        return itertools.imap(Transaction, values)
+
+    def count_groups(self, row_filter=None):
+        """ Return the rows of each Trans # and the account index, as
+        FileParser.count_groups does """
+        rowsUnder = [0] * len(self.paths)
+        for account in self.sections['accounts']:
+            rowsUnder[account] += 1
+        accounts = collections.OrderedDict(itertools.izip(self.paths, rowsUnder))
+
+        counts = collections.defaultdict(int)
+        lookup = self.strings.__getitem__
+        if row_filter is None:
+            counts.update(itertools.izip(itertools.imap(lookup, self.sections['group ids']), self.sections['group counts']))
+        else:
+            for transId in itertools.compress(self.sections['Trans #'], self.selected(row_filter)):
+                counts[transId] += 1
+            counts = collections.defaultdict(int, itertools.izip(itertools.imap(lookup, counts), counts.itervalues()))
+        return counts, accounts
+
+class ParseCache(object):
+    """ A directory of CachedExports, so that an export converted again, for
+    example with other settings, isn't parsed again.  The entry of an export
+    is found by its path and is only used while the size, modification time
+    and content of the export are unchanged.  When the entries take more
+    than max_bytes the least recently used ones are removed. """
+    extension = '.qbcache'
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry_filename(self, filename):
+        key = hashlib.md5(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.directory, key + self.extension)
+
+    def load(self, filename, log_writer, stats=None, processes=None):
+        """ Return the CachedExport of an export, parsing it and storing the
+        entry first if there is no current one """
+        start = time.time()
+        fingerprint = file_fingerprint(filename)
+        entryFilename = self.entry_filename(filename)
+
+        if os.path.exists(entryFilename):
+            export = CachedExport.read(entryFilename, fingerprint)
+            if export is not None:
+                # the modification time of an entry is when it was last used
+                try:
+                    os.utime(entryFilename, None)
+                except OSError:
+                    pass
+                if stats is not None:
+                    stats.add('cache read', time.time() - start, export.rows)
+                    stats.count('cache hits')
+                return export
+
+        parser = FileParser(filename, log_writer, stats, processes)
+        export = CachedExport.from_rows(fingerprint, parser.iter_rows(), parser.accountPaths)
+        start = time.time()
+        # a cache that can't be written only costs the next run a parse
+        try:
+            self.store(entryFilename, export)
+        except (IOError, OSError), e:
+            log_writer.write('Could not write the parse cache %s (%s)' % (entryFilename, e))
+        if stats is not None:
+            stats.add('cache write', time.time() - start, export.rows)
+            stats.count('cache misses')
+        return export
+
+    def store(self, entryFilename, export):
+        """ Write an entry through a temporary file, then evict old entries """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, temp_filename = tempfile.mkstemp('.tmp', '', self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                export.write(f)
+            replace_file(temp_filename, entryFilename)
+        except:
+            os.remove(temp_filename)
+            raise
+        self.evict(entryFilename)
+
+    def evict(self, keep=None):
+        """ Remove the least recently used entries, other than keep, until
+        the entries take at most max_bytes """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.extension):
+                entryFilename = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(entryFilename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entryFilename))
+
+        total = sum([ size for mtime, size, entryFilename in entries ])
+        for mtime, size, entryFilename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entryFilename == keep:
+                continue
+            # another conversion may be removing or reading it
+            try:
+                os.remove(entryFilename)
+            except OSError:
+                continue
+            total -= size
+
+
+class GroupSpool(object):
+    """ Collects rows into transaction groups, spilling open groups to a
+    temporary file whenever more than max_rows rows are held in memory.
+    The spill file is spill_filename if given, so that a checkpoint of the
+    spool outlives the process. """
+
+    def __init__(self, counts, max_rows=None, spill_filename=None):
+        self.counts = counts
+        self.max_rows = max_rows
+        self.spill_filename = spill_filename
+        self.open = {}      # Trans # -> rows held in memory
+        self.seen = {}      # Trans # -> number of rows seen so far
+        self.first = {}     # Trans # -> position of the group's first row
+        self.spilled = {}   # Trans # -> offsets of the chunks written to disk
+        self.position = 0
+        self.held = 0
+        self.spills = 0
+        self.spill_file = None
+
+    def add(self, row):
+        """ Add a row, returning its group if the row completed it """
+        transId = row['Trans #']
+        self.position += 1
+
+        rows = self.open.get(transId)
+        if rows is None:
+            rows = self.open[transId] = []
+        rows.append(row)
+
+        seen = self.seen.get(transId, 0) + 1
+        if seen >= self.counts.get(transId, 0):
+            self.held -= len(rows) - 1
+            return self.pop(transId)
+
+        if seen == 1:
+            self.first[transId] = self.position
+        self.seen[transId] = seen
+        self.held += 1
+        if self.max_rows is not None and self.held > self.max_rows:
+            self.spill()
+        return None
+
+    def pop(self, transId):
+        """ Remove a group, reading back any of its rows that were spilled """
+        rows = self.open.pop(transId, [])
+        self.seen.pop(transId, None)
+        self.first.pop(transId, None)
+
+        offsets = self.spilled.pop(transId, None)
+        if offsets:
+            f = self.spill_file
+            spilledRows = []
+            for offset in offsets:
+                f.seek(offset)
+                chunk = cPickle.load(f)
+                if chunk[0].__class__ is tuple:
+                    chunk = map(Transaction, chunk)
+                spilledRows.extend(chunk)
+            f.seek(0, os.SEEK_END)
+            rows = spilledRows + rows
+        return rows
+
+    def spill(self):
+        """ Write every group held in memory to the spill file """
+        if self.spill_file is None:
+            if self.spill_filename is None:
+                self.spill_file = tempfile.TemporaryFile()
+            else:
+                self.spill_file = open(self.spill_filename, 'w+b')
+
+        self.spills += 1
+        f = self.spill_file
+        for transId, rows in self.open.iteritems():
+            self.spilled.setdefault(transId, []).append(f.tell())
+            # Transactions are spilled as plain tuples, which pickle several times faster
+            if rows[0].__class__ is Transaction:
+                rows = map(tuple, rows)
+            cPickle.dump(rows, f, cPickle.HIGHEST_PROTOCOL)
+        self.open.clear()
+        self.held = 0
+
+    def checkpoint(self):
+        """ Spill every open group and sync the spill file, returning the
+        state restore needs to recreate the spool """
+        if self.open:
+            self.spill()
+        spillSize = 0
+        if self.spill_file is not None:
+            self.spill_file.flush()
+            os.fsync(self.spill_file.fileno())
+            spillSize = self.spill_file.tell()
+        return dict(seen=self.seen, first=self.first, spilled=self.spilled, position=self.position,
+                    spills=self.spills, spill_size=spillSize)
+
+    def restore(self, state):
+        """ Continue from a checkpoint, dropping anything spilled after it """
+        self.seen = state['seen']
+        self.first = state['first']
+        self.spilled = state['spilled']
+        self.position = state['position']
+        self.spills = state['spills']
+        self.open = {}
+        self.held = 0
+        if state['spill_size']:
+            self.spill_file = open(self.spill_filename, 'r+b')
+            self.spill_file.truncate(state['spill_size'])
+            self.spill_file.seek(0, os.SEEK_END)
+
+    def remaining(self):
+        """ Yield the groups that never reached their expected row count """
+        for transId in sorted(self.seen, key=self.first.get):
+            yield transId, self.pop(transId)
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def count_transactions(transactions):
+    """ Count the rows belonging to each Trans # """
+    counts = collections.defaultdict(int)
+    for trans in transactions:
+        counts[trans['Trans #']] += 1
+    return counts
+
+def group_transactions(transactions, counts, max_rows=None, stats=None, spool=None):
+    """ Yield (Trans #, rows) for each transaction group as soon as its last row is seen """
+    if spool is None:
+        spool = GroupSpool(counts, max_rows)
+    try:
+        if stats is None:
+            for trans in transactions:
+                rows = spool.add(trans)
+                if rows is not None:
+                    yield trans['Trans #'], rows
+
+            for group in spool.remaining():
+                yield group
+        else:
+            for group in group_transactions_timed(spool, transactions, stats):
+                yield group
+    finally:
+        spool.close()
+
+def group_transactions_timed(spool, transactions, stats):
+    """ The loop of group_transactions, timing the time spent grouping """
+    clock = time.time
+    grouping = 0.0
+    rows = groups = 0
+    try:
+        for trans in transactions:
+            start = clock()
+            group = spool.add(trans)
+            grouping += clock() - start
+
+            rows += 1
+            if group is not None:
+                groups += 1
+                yield trans['Trans #'], group
+
+        for group in spool.remaining():
+            groups += 1
+            yield group
+    finally:
+        stats.add('grouping', grouping, rows)
+        stats.count('groups', groups)
+        stats.count('spills', spool.spills)
+
+
+def trans_key(transId):
+    """ Sort key putting numeric Trans # in numeric order """
+    return int(transId) if transId.isdigit() else transId
+
+class GroupMerger(object):
+    """ Merges the rows of several exports into transaction groups by Trans #.
+
+    Each source is sorted by Trans # in runs of max_rows rows that are
+    written to a temporary file, and the runs of all sources are merged.
+    Sorting holds max_rows rows in memory, and merging one piece of
+    piece_size rows of every run, so rows / max_rows * piece_size rows in
+    all.  A row that appears in more than one source, because the exports
+    overlap, is kept as often as the source holding it most often has it.
+    Groups are yielded in Trans # order, each with its rows in the order of
+    the first source holding them, as a conversion of that source has them.
+    """
+    def __init__(self, sources, max_rows=DEFAULT_MAX_ROWS, piece_size=DEFAULT_CHUNK_SIZE):
+        self.sources = sources
+        self.max_rows = max_rows
+        self.piece_size = piece_size
+        self.duplicates = 0
+        self.runs = 0
+        self.run_file = None
+
+    def __iter__(self):
+        self.run_file = tempfile.TemporaryFile()
+        try:
+            streams = [ self.sort_rows(rows, tag) for tag, rows in enumerate(self.sources) ]
+            for key, items in itertools.groupby(heapq.merge(*streams), operator.itemgetter(0)):
+                yield self.dedupe(items)
+        finally:
+            self.run_file.close()
+            self.run_file = None
+
+    def dedupe(self, items):
+        """ Build a (Trans #, rows) group from its (key, source, number, row)
+        items, which come by source and then in file order.  A source only
+        adds the copies of a row beyond those the sources before it had. """
+        rows = []
+        kept = collections.defaultdict(int)
+        count = 0
+        for tag, sourceItems in itertools.groupby(items, operator.itemgetter(1)):
+            seen = collections.defaultdict(int)
+            for key, tag, number, row in sourceItems:
+                count += 1
+                seen[row] += 1
+                if seen[row] > kept[row]:
+                    kept[row] += 1
+                    rows.append(row)
+        self.duplicates += count - len(rows)
+        return rows[0]['Trans #'], rows
+
+    def sort_rows(self, rows, tag):
+        """ Yield (key, tag, number, row) for rows in Trans # order, numbering
+        them so that each group keeps the order of the file """
+        pieces = []
+        numbers = itertools.count()
+        for chunk in iter_chunks(rows, self.max_rows):
+            run = sorted([ (trans_key(row['Trans #']), tag, next(numbers), row) for row in chunk ])
+            pieces.append(self.write_run(run))
+        return heapq.merge(*[ self.read_run(offsets) for offsets in pieces ])
+
+    def write_run(self, run):
+        """ Write a sorted run to the run file, returning the offsets of its pieces """
+        f = self.run_file
+        f.seek(0, os.SEEK_END)
+        self.runs += 1
+        offsets = []
+        for start in xrange(0, len(run), self.piece_size):
+            offsets.append(f.tell())
+            cPickle.dump(run[start:start + self.piece_size], f, cPickle.HIGHEST_PROTOCOL)
+        return offsets
+
+    def read_run(self, offsets):
+        f = self.run_file
+        for offset in offsets:
+            f.seek(offset)
+            for item in cPickle.load(f):
+                yield item
+
+
+class GroupSummary(object):
+    """ What deciphering a transaction group needs to know about its rows,
+    gathered in one pass: the rows with positive and with negative amounts
+    and their amounts, and the numeric key of its Trans # """
+    __slots__ = ('rows', 'positive', 'negative', 'positive_amounts', 'negative_amounts')
+
+    amount_column = Transaction.index['Amount']
+
+    def __init__(self, rows):
+        self.rows = rows
+        # the amounts of Transactions are read by position, without a lookup by name for each row
+        if rows[0].__class__ is Transaction:
+            item, column = tuple.__getitem__, self.amount_column
+            amounts = [ item(row, column) for row in rows ]
+        else:
+            amounts = [ row['Amount'] for row in rows ]
+        positive, negative = [], []
+        positiveAmounts, negativeAmounts = [], []
+        for row, amount in itertools.izip(rows, amounts):
+            if amount > 0:
+                positive.append(row)
+                positiveAmounts.append(amount)
+            elif amount < 0:
+                negative.append(row)
+                negativeAmounts.append(amount)
+        self.positive, self.negative = positive, negative
+        self.positive_amounts, self.negative_amounts = positiveAmounts, negativeAmounts
+
+    @property
+    def void(self):
+        """ Whether no row of the group moves any money """
+        return not self.positive and not self.negative
+
+    def amount_sum(self, rows):
+        """ Sum the amounts of rows, from the amounts of the first pass if they
+        are the positive or negative rows """
+        if rows is self.positive:
+            return sum_amounts(self.positive_amounts)
+        if rows is self.negative:
+            return sum_amounts(self.negative_amounts)
+        return sum_amounts([ row['Amount'] for row in rows ])
+
+    def describe(self):
+        """ Diagnostics for the log of a group that could not be deciphered """
+        return '%d rows, %d positive totalling %s, %d negative totalling %s' % (
+            len(self.rows), len(self.positive), format_amount(sum_amounts(self.positive_amounts)),
+            len(self.negative), format_amount(sum_amounts(self.negative_amounts)))
+
+def split_outgoing(summary):
+    """ Handler for types that take money out of an account: the transaction
+    is the row with a negative amount and the splits are the positive rows """
+    return summary.negative, summary.positive
+
+def split_incoming(summary):
+    """ Handler for types that put money into an account: the transaction
+    is the row with a positive amount and the splits are the negative rows """
+    return summary.positive, summary.negative
+
+def split_journal(summary):
+    """ Handler for journal entries, which have no single source account: the
+    first row is the transaction and the others balance it """
+    return summary.rows[:1], list(summary.rows[1:])
+
+
+class FailureLog(object):
+    """ The groups a conversion could not write.  Parse errors, and the groups
+    that could not be deciphered for another reason than being void, are
+    logged with their diagnostics as they happen.  The transactions of types
+    that aren't handled and the voided ones are listed once the whole file
+    is written. """
+
+    def __init__(self, log_writer, stats=None, progress=None):
+        self.log_writer = log_writer
+        self.stats = stats
+        self.progress = progress
+        # don't handle any type of transaction other than check and deposit
+        self.types = set()
+        self.not_implemented = []
+        self.voids = []
+        self.messages = []  # the messages logged so far, which a resumed conversion logs again
+
+    def record(self, transId, e):
+        if self.stats is not None:
+            self.stats.failure(e)
+        if self.progress is not None:
+            self.progress.failure()
+        if isinstance(e, NotImplementedError):
+            self.types.add(str(e))
+            self.not_implemented.append(transId)
+        elif isinstance(e, VoidError) and not isinstance(e, AmbiguousError):
+            self.voids.append(transId)
+        else:
+            message = '%s - %s' % (transId, e)
+            self.messages.append(message)
+            self.log_writer.write(message)
+
+    def report(self):
+        if self.types:
+            self.not_implemented.sort(key=trans_key)
+            self.log_writer.write('This program in not yet able to translate any of these types %s.  These transactions were not added %s' % (list(self.types), self.not_implemented))
+        if self.voids:
+            self.voids.sort(key=trans_key)
+            self.log_writer.write('Some transactions could not be written.  This could be caused by a transaction amount of $0.00 (i.e. a voided check).  These transactions were not added %s' % self.voids)
 
-        return transactions
+    def state(self):
+        return self.types, self.not_implemented, self.voids, self.messages
+
+    def restore(self, state):
+        """ Continue from a saved state, logging its messages again """
+        self.types, self.not_implemented, self.voids, self.messages = state
+        for message in self.messages:
+            self.log_writer.write(message)
 
 
 class IIFGenerator(object):
@@ -160,71 +1494,256 @@ class IIFGenerator(object):
     split_tpl = 'SPL\t\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\n'
     trans_end_tpl = 'ENDTRNS\n'
 
-    def __init__(self, iif_filename, log_writer):
+    # handlers splitting the GroupSummary of a group of each Type into the
+    # main transaction and its splits, add to these to convert other types
+    handlers = {
+        'Check': split_outgoing,
+        'Bill': split_outgoing,
+        'Bill Pmt -Check': split_outgoing,
+        'Bill Pmt -CCard': split_outgoing,
+        'Credit Card Charge': split_outgoing,
+        'Sales Tax Payment': split_outgoing,
+        'Transfer': split_outgoing,
+        'Deposit': split_incoming,
+        'Credit Card Credit': split_incoming,
+        'Sales Receipt': split_incoming,
+        'Payment': split_incoming,
+        'General Journal': split_journal,
+    }
+
+    # iif TRNSTYPE of the types whose name in the export differs from it
+    iif_types = {
+        'Bill': 'BILL',
+        'Bill Pmt -Check': 'BILLPMT',
+        'Bill Pmt -CCard': 'BILLPMT',
+        'Credit Card Charge': 'CREDIT CARD',
+        'Credit Card Credit': 'CCARD REFUND',
+        'Sales Tax Payment': 'SALES TAX PAYMENT',
+        'Transfer': 'TRANSFER',
+        'Sales Receipt': 'CASH SALE',
+        'Payment': 'PAYMENT',
+        'General Journal': 'GENERAL JOURNAL',
+    }
+
+    def __init__(self, iif_filename, log_writer, stats=None):
         self.iif_filename = iif_filename
         self.log_writer = log_writer
-
-    def numeric_compare(self, x, y):
-        return cmp(int(x), int(y))
-
-    def generate(self, transactions):
-        # don't handle any type of transaction other than check and deposit
-        typesNotImplemented = [set(), []]
-        voidErrors = []
-
-        # any transaction that fails will be shown to the user
-        failures = []
-
-        # index transactions by id
-        transMap = collections.defaultdict(list)
-        for trans in transactions:
-            transId = trans['Trans #']
-            transMap[transId].append(trans)
-
-        with open(self.iif_filename, 'w') as f:
+        self.stats = stats
+        self.progress = None
+        self.atomic = False      # only replace the iif file once it is complete
+        self.compression = None  # gz, bz2 or xz to compress the iif file
+        self.filtered = False    # the export was cut down by a RowFilter, so a group may only hold its split side
+        self.recreated = []      # Trans # of the transactions recreated from their split side
+        self.account_names = {}  # account path -> name in the iif file
+
+    def generate(self, transactions, processes=None):
+        """ Write the iif file from a list of parsed rows """
+        counts = count_transactions(transactions)
+        if self.progress is not None:
+            self.progress.total = len(counts)
+        self.write_groups(group_transactions(transactions, counts, stats=self.stats), processes)
+
+    def generate_streaming(self, parser, max_rows=DEFAULT_MAX_ROWS, processes=None):
+        """ Write the iif file while the input is still being read, holding
+        at most max_rows rows of open transaction groups in memory """
+        counts = parser.count_groups()
+        if self.progress is not None:
+            self.progress.total = len(counts)
+        self.write_groups(group_transactions(parser.iter_rows(), counts, max_rows, parser.stats), processes)
+
+    def generate_checkpointed(self, parser, checkpoint, max_rows=DEFAULT_MAX_ROWS):
+        """ Write the iif file like generate_streaming, but serially and saving
+        checkpoints.  A checkpoint is only taken once a group has been written,
+        with every open group spilled and the spill and iif files synced, so a
+        conversion resumed from it writes the same iif file as one that was
+        never interrupted. """
+        stat = os.stat(parser.filename)
+        source = (stat.st_size, stat.st_mtime)
+        state = checkpoint.load(source)
+
+        counts = parser.count_groups()
+        if self.progress is not None:
+            self.progress.total = len(counts)
+
+        failureLog = FailureLog(self.log_writer, self.stats, self.progress)
+        spool = GroupSpool(counts, max_rows, checkpoint.spill_filename)
+        if state is None:
+            rows = parser.iter_rows_from()
+            f = IIFWriter(self.iif_filename, self.atomic, resumable=True)
+            f.write(self.file_start_tpl)
+        else:
+            failureLog.restore(state['failures'])
+            self.recreated = state['recreated']
+            spool.restore(state['spool'])
+            rows = parser.iter_rows_from(state['input'])
+            f = IIFWriter(self.iif_filename, self.atomic, resumable=True, offset=state['output'])
+        if self.progress is not None:
+            rows = self.progress.iter_rows(rows)
+
+        groups = group_transactions(rows, counts, max_rows, spool=spool)
+        if self.progress is not None:
+            groups = self.progress.iter_groups(groups)
+
+        with f:
+            due = spool.position + checkpoint.interval
+            for transId, transactions in groups:
+                e = self.write_group(transId, transactions, f)
+                if e is not None:
+                    failureLog.record(transId, e)
+
+                # the rows read so far are either written or in the spool
+                if spool.position >= due:
+                    start = time.time()
+                    state = dict(source=source, input=parser.position(), spool=spool.checkpoint(),
+                                 output=f.sync(), failures=failureLog.state(), recreated=self.recreated)
+                    checkpoint.save(state)
+                    checkpoint.seconds += time.time() - start
+                    due = spool.position + checkpoint.interval
+
+        failureLog.report()
+        self.report_recreated()
+        checkpoint.remove()
+        if self.stats is not None:
+            self.stats.add('checkpoint', checkpoint.seconds, checkpoint.saves)
+            self.stats.count('checkpoints', checkpoint.saves)
+
+    def generate_merged(self, parsers, max_rows=DEFAULT_MAX_ROWS, processes=None):
+        """ Write one iif file from several exports, which may overlap, merging
+        their transaction groups by Trans # """
+        merger = GroupMerger([ parser.iter_rows() for parser in parsers ], max_rows)
+        self.write_groups(merger, processes)
+
+        if self.stats is not None:
+            self.stats.count('duplicate rows', merger.duplicates)
+            self.stats.count('sorted runs', merger.runs)
+        if merger.duplicates:
+            self.log_writer.write('%s duplicate rows found in more than one file were removed' % merger.duplicates)
+
+    def write_groups(self, groups, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """ Decipher and write each (Trans #, rows) group in the order given.
+        With more than one process the groups are rendered by a pool of
+        workers, but the file and log are written in the same order. """
+        failureLog = FailureLog(self.log_writer, self.stats, self.progress)
+        record_failure = failureLog.record
+
+        if self.progress is not None:
+            groups = self.progress.iter_groups(groups)
+
+        with IIFWriter(self.iif_filename, self.atomic, compression=self.compression) as f:
             f.write(self.file_start_tpl)
 
-            for transId, transactions in transMap.iteritems():
+            if processes is None or processes < 2:
+                if self.stats is None:
+                    for transId, transactions in groups:
+                        e = self.write_group(transId, transactions, f)
+                        if e is not None:
+                            record_failure(transId, e)
+                else:
+                    self.write_groups_timed(groups, f, record_failure)
+            else:
+                for text, failures, sizes, recreated in self.render_parallel(groups, processes, chunk_size):
+                    f.write(text)
+                    self.recreated.extend(recreated)
+                    for transId, e in failures:
+                        record_failure(transId, e)
+                    if self.stats is not None:
+                        self.stats.count('transactions written', len(sizes))
+                        for transId, splits in sizes:
+                            self.stats.group(transId, splits)
+
+        failureLog.report()
+        self.report_recreated()
+
+    def report_recreated(self):
+        if self.recreated:
+            self.recreated.sort(key=trans_key)
+            self.log_writer.write('Only the split side of these transactions is in the filtered export, so they were '
+                                  'recreated from it and may be missing other splits %s' % self.recreated)
+
+    def write_groups_timed(self, groups, f, record_failure):
+        """ The serial loop of write_groups, timing deciphering and writing separately """
+        clock = time.time
+        deciphering = writing = 0.0
+        groupCount = written = 0
+        try:
+            for transId, transactions in groups:
+                groupCount += 1
+                start = clock()
                 try:
                     trans, splits = self.decipher_transactions(transactions)
+                except (ParseError, NotImplementedError, VoidError), e:
+                    deciphering += clock() - start
+                    record_failure(transId, e)
+                    continue
+
+                middle = clock()
+                self.write_transaction(trans, splits, f)
+                writing += clock() - middle
+                deciphering += middle - start
+
+                written += 1
+                self.stats.group(transId, len(splits))
+        finally:
+            self.stats.add('decipher', deciphering, groupCount)
+            self.stats.add('write', writing, written)
+            self.stats.count('transactions written', written)
+
+    def write_group(self, transId, transactions, f):
+        """ Decipher and write one group, returning the error if it could not be converted """
+        try:
+            trans, splits = self.decipher_transactions(transactions)
+
+            self.write_transaction(trans, splits, f)
+        except (ParseError, NotImplementedError, VoidError), e:
+            return e
+        return None
+
+    def render_parallel(self, groups, processes, chunk_size):
+        """ Render chunks of groups on a pool of worker processes, yielding
+        (text, failures, sizes, recreated) for each chunk in the order the
+        groups were given """
+        start = time.time()
+        counted = [0]
+
+        def jobs():
+            # handlers or iif types set on this generator have to reach the workers too
+            for chunk in iter_chunks(groups, chunk_size):
+                counted[0] += len(chunk)
+                yield self.__class__, self.handlers, self.iif_types, self.filtered, chunk
 
-                    self.write_transaction(trans, splits, f)
-                except ParseError, e:
-                    self.log_writer.write('%s - %s' % (transId, e))
-                except NotImplementedError, e:
-                    typesNotImplemented[0].add(str(e))
-                    typesNotImplemented[1].append(transId)
-                except VoidError, e:
-                    voidErrors.append(transId)
-
-        if typesNotImplemented[0]:
-            typesNotImplemented[1].sort(cmp=self.numeric_compare)
-            self.log_writer.write('This program in not yet able to translate any of these types %s.  These transactions were not added %s' % (list(typesNotImplemented[0]), typesNotImplemented[1]))
-        if voidErrors:
-            voidErrors.sort(cmp=self.numeric_compare)
-            self.log_writer.write('Some transactions could not be written.  This could be caused by a transaction amount of $0.00 (i.e. a voided check).  These transactions were not added %s' % voidErrors)
-
+        try:
+            for result in imap_ordered(processes, render_chunk, jobs()):
+                yield result
+        finally:
+            # the workers decipher and write together, so only the total is known
+            if self.stats is not None:
+                self.stats.add('render', time.time() - start, counted[0])
 
     def decipher_transactions(self, transactions):
-        outgoing = ['Check']
-        incoming = ['Deposit']
-
         tType = transactions[0]['Type']
 
-        if tType in outgoing:
-            tranList = [ val for val in transactions if val['Amount'] < 0 ]
-            splits =  [ val for val in transactions if val['Amount'] > 0 ]
-        elif tType in incoming:
-            tranList = [ val for val in transactions if val['Amount'] > 0 ]
-            splits =  [ val for val in transactions if val['Amount'] < 0 ]
-        elif transactions[0]['Amount'] == 0:
-            tranList = [ val for val in transactions if val['Split'] == 'void' ]
-            tranList = [ val for val in transactions if val['Split'] != 'void' ]
-        else:
+        handler = self.handlers.get(tType)
+        if handler is None:
+            # a voided transaction can't be deciphered whatever its type
+            if transactions[0]['Amount'] == 0:
+                raise VoidError('There was a problem deciphering the data, possibly because the transaction amount is $0.00')
             raise NotImplementedError(tType)
+        summary = GroupSummary(transactions)
+        tranList, splits = handler(summary)
+        splitSum = None
+
+        # a filtered export may only hold the split side of a transaction
+        if self.filtered and not tranList and len(splits) == 1 and splits[0]['Split'] not in ('', '-SPLIT-'):
+            spl = splits[0]
+            tranList = [copy_row(spl, Amount=-1 * spl['Amount'], AccountName=(spl['Split'],),
+                                 Split=spl['AccountName'][-1])]
+            self.recreated.append(spl['Trans #'])
 
         if len(tranList) != 1:
-            raise VoidError('There was a problem deciphering the data, possibly because the transaction amount is $0.00')
+            if summary.void:
+                raise VoidError('There was a problem deciphering the data, possibly because the transaction amount is $0.00')
+            raise AmbiguousError('There was a problem deciphering the data, %d rows could be the transaction (%s)'
+                            % (len(tranList), summary.describe()))
 
         trans = tranList[0]
 
@@ -235,26 +1754,38 @@ class IIFGenerator(object):
             elif trans['Split'] == '':
                 raise ParseError('There are no splits specified')
             else:
-                spl = dict(trans)
-                spl['Amount'] = -1 * spl['Amount']
-                spl['AccountName'], spl['Split'] = [ spl['Split'] ], spl['AccountName'][-1]
+                spl = copy_row(trans, Amount=-1 * trans['Amount'], AccountName=(trans['Split'],),
+                               Split=trans['AccountName'][-1])
                 splits.append(spl)
+                splitSum = spl['Amount']
 
         # check to make sure splits add up
-        tranSum = -Decimal(trans['Amount'])
-        splitSum = sum([ val['Amount'] for val in splits ])
-        if not tranSum == splitSum:
-            raise ParseError('The sum of the splits does not equal the total of the transaction')
+        tranSum = -trans['Amount']
+        if splitSum is None:
+            splitSum = summary.amount_sum(splits)
+        if not amounts_equal(tranSum, splitSum):
+            raise ParseError('The sum of the splits does not equal the total of the transaction (%s against %s; %s)'
+                             % (format_amount(trans['Amount']), format_amount(splitSum), summary.describe()))
 
         return trans, splits
 
+    def account_name(self, path):
+        """ Return an account path joined the way the iif file names it """
+        if type(path) is not tuple:
+            # map rows may give the path as a list
+            path = tuple(path)
+        name = self.account_names.get(path)
+        if name is None:
+            name = self.account_names[path] = ':'.join(path)
+        return name
+
     def write_transaction(self, trans, splits, f):
         # create the main transaction
-        accountName = ':'.join(trans['AccountName'])
-        tType = trans['Type']
+        accountName = self.account_name(trans['AccountName'])
+        tType = self.iif_types.get(trans['Type'], trans['Type'])
         date = trans['Date']
         name = trans['Name']
-        amount = trans['Amount']
+        amount = format_amount(trans['Amount'])
         memo = trans['Memo']
         num = trans['Num'] if trans['Num'] else ''
         cleared = 'N'
@@ -262,73 +1793,764 @@ class IIFGenerator(object):
         address1 = ''
         address2 = ''
 
-        trans = self.trans_tpl % (tType, date, accountName, name, amount, num, memo, cleared, toPrint, address1, address2)
-        f.write(trans)
+        lines = [self.trans_tpl % (tType, date, accountName, name, amount, num, memo, cleared, toPrint, address1, address2)]
 
         # create the splits
+        splCleared = 'N'
         for spl in splits:
-            splAccount = ':'.join(spl['AccountName'])
-            splAmount = spl['Amount']
-            splCleared = 'N'
-            splString = self.split_tpl % (tType, date, splAccount, name, splAmount, num, memo, splCleared)
-            f.write(splString)
+            splAccount = self.account_name(spl['AccountName'])
+            splAmount = format_amount(spl['Amount'])
+            lines.append(self.split_tpl % (tType, date, splAccount, name, splAmount, num, memo, splCleared))
+
+        # the whole transaction goes to the writer in one piece
+        lines.append(self.trans_end_tpl)
+        f.write(''.join(lines))
+
+
+class IIFWriter(object):
+    """ Collects the text of an iif file and writes it out buffer_size bytes
+    at a time.  An atomic writer writes to a temporary file next to filename
+    and only renames it to filename once it is complete, so nobody ever sees
+    a partial iif file.  The file is compressed if compression is gz, bz2 or
+    xz.  As a context manager the file is completed when the block succeeds
+    and discarded when it raises, and removed if the conversion was cancelled.
+
+    A resumable writer keeps what it has written when it is discarded, and
+    an uncompressed file can be continued from an offset reached by sync. """
+
+    def __init__(self, filename, atomic=False, buffer_size=DEFAULT_BUFFER_SIZE, compression=None,
+                 resumable=False, offset=None):
+        self.filename = filename
+        self.temp_filename = filename + '.tmp' if atomic else None
+        self.buffer_size = buffer_size
+        self.resumable = resumable
+        self.parts = []
+        self.size = 0
+        if offset is None:
+            self.f = open_output(self.temp_filename or filename, compression)
+        else:
+            partial = self.temp_filename or filename
+            if self.temp_filename is not None and not os.path.exists(partial) and os.path.exists(filename):
+                # the last run was stopped after it renamed the finished file
+                shutil.copyfile(filename, partial)
+            # in the mode open_output created it with, so the line endings match;
+            # anything written after the offset was not synced, so it may be incomplete
+            self.f = open(partial, 'r+')
+            self.f.truncate(offset)
+            self.f.seek(offset)
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.f.writelines(self.parts)
+        del self.parts[:]
+        self.size = 0
+
+    def sync(self):
+        """ Write everything out to the disk, returning the size of the file """
+        self.flush()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.temp_filename is not None:
+            replace_file(self.temp_filename, self.filename)
+
+    def discard(self, remove=False):
+        """ Close the file without completing it, removing what was written if
+        remove is set or it is a temporary file nobody will resume """
+        if remove or self.temp_filename is not None and not self.resumable:
+            self.f.close()
+            os.remove(self.temp_filename or self.filename)
+            return
+        if not self.resumable:
+            self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is None:
+            self.close()
+        else:
+            self.discard(issubclass(type_, Cancelled))
+
+
+def transaction_digest(trans, splits):
+    """ Hash everything about a deciphered transaction that ends up in the iif file """
+    fields = [trans['Type'], trans['Date'], ':'.join(trans['AccountName']), trans['Name'],
+              format_amount(trans['Amount']), trans['Num'], trans['Memo']]
+    for spl in splits:
+        fields.append(':'.join(spl['AccountName']))
+        fields.append(format_amount(spl['Amount']))
+    return hashlib.md5('\0'.join([ str(field) for field in fields ])).hexdigest()
 
-        f.write(self.trans_end_tpl)
+class TransactionIndex(object):
+    """ The sidecar file of an incremental export, mapping each Trans # to
+    the digest of the transaction last written for it """
 
+    def __init__(self, filename):
+        self.filename = filename
+        self.digests = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    transId, digest = line.rstrip('\n').rsplit('\t', 1)
+                    self.digests[transId] = digest
+
+    def save(self):
+        """ Write the index to a temporary file first so a failed save keeps the old one """
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            for transId, digest in self.digests.iteritems():
+                f.write('%s\t%s\n' % (transId, digest))
+        replace_file(temp_filename, self.filename)
+
+class Checkpoint(object):
+    """ The sidecar files of a resumable conversion: the state saved by the
+    last checkpoint, and the spill file holding the transaction groups that
+    were open at it.  A checkpoint is saved at the first group boundary after
+    every interval rows.  Unless resume is set any earlier checkpoint is
+    ignored, and the conversion starts from the beginning. """
+
+    def __init__(self, filename, interval=DEFAULT_CHECKPOINT_ROWS, resume=False):
+        self.filename = filename
+        self.spill_filename = filename + '.spill'
+        self.interval = interval
+        self.resume = resume
+        self.saves = 0
+        self.seconds = 0.0
+
+    def load(self, source):
+        """ Return the state saved for source, the (size, mtime) of the export,
+        or None if there is nothing to resume """
+        if not self.resume or not os.path.exists(self.filename):
+            return None
+        with open(self.filename, 'rb') as f:
+            state = marshal.load(f)
+        if state['source'] != source:
+            raise ValueError('the export has changed since the checkpoint %s was saved' % self.filename)
+        return state
+
+    def save(self, state):
+        """ Replace the checkpoint with state once it is safely on the disk """
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            # the state is only plain maps, lists and strings, which marshal
+            # writes several times faster than pickle
+            marshal.dump(state, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_filename, self.filename)
+        self.saves += 1
+
+    def remove(self):
+        # a process killed while saving leaves the temporary file behind too
+        for filename in (self.filename, self.filename + '.tmp', self.spill_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class IncrementalIIFGenerator(IIFGenerator):
+    """ Writes only the transactions that are new or have changed since the
+    index was last saved.  Groups are deciphered to compute their digest,
+    but unchanged ones are never rendered.  Always runs serially, since the
+    index has to be consulted for every group. """
+
+    def __init__(self, iif_filename, log_writer, stats=None, index=None):
+        IIFGenerator.__init__(self, iif_filename, log_writer, stats)
+        self.index = index
+        self.new = []
+        self.changed = []
+        self.unchanged = 0
+
+    def write_groups(self, groups, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        IIFGenerator.write_groups(self, groups, None, chunk_size)
+
+        if self.stats is not None:
+            self.stats.count('unchanged', self.unchanged)
+        if self.new:
+            self.new.sort(key=trans_key)
+            self.log_writer.write('New transactions written %s' % self.new)
+        if self.changed:
+            self.changed.sort(key=trans_key)
+            self.log_writer.write('Changed transactions written %s' % self.changed)
+        self.log_writer.write('%s unchanged transactions were skipped' % self.unchanged)
 
-def get_iif_filename(filename):
+    def write_transaction(self, trans, splits, f):
+        transId = trans['Trans #']
+        digest = transaction_digest(trans, splits)
+        previous = self.index.digests.get(transId)
+        if previous == digest:
+            self.unchanged += 1
+            return
+
+        if previous is None:
+            self.new.append(transId)
+        else:
+            self.changed.append(transId)
+        self.index.digests[transId] = digest
+        IIFGenerator.write_transaction(self, trans, splits, f)
+
+
+def replace_file(temp_filename, filename):
+    """ Move a finished temporary file over filename """
+    # windows can't rename over an existing file, elsewhere the rename is atomic
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(temp_filename, filename)
+
+def iter_chunks(iterable, size):
+    """ Yield lists of up to size items from iterable """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def imap_ordered(processes, function, jobs):
+    """ Run function(*job) for every job on a pool of worker processes,
+    yielding the results in order.  Only a couple of jobs per process are
+    in flight at a time, so memory stays bounded. """
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.apply_async(function, job))
+            if len(pending) > processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def record_end(mm, position, quotes=0):
+    """ Return the offset just past the end of the csv record that contains
+    position.  quotes is the number of quote characters between the start of
+    that record and position, by default position is taken to be outside any
+    quoted field. """
+    size = len(mm)
+    while position < size:
+        newline = mm.find('\n', position)
+        if newline < 0:
+            return size
+        quotes += mm[position:newline].count('"')
+        position = newline + 1
+        if not quotes % 2:
+            break
+    return min(position, size)
+
+def parse_chunk(filename, start, end, stack, lineNumber, columnArray, rowFilter=None):
+    """ Worker process side of FileParser.iter_rows_parallel.  Returns the
+    values of the rows in the chunk, and the line number of a csv error if
+    there was one """
+    parser = FileParser(filename, None, row_filter=rowFilter)
+    parser.currentAccount = list(stack)
+    parser.update_account()
+
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = mm[start:end]
+        finally:
+            mm.close()
+
+    rows = []
+    reader = csv.reader(cStringIO.StringIO(data))
+    try:
+        for line in reader:
+            transaction = parser.get_data_row(line, columnArray)
+            if transaction is not None:
+                rows.append(transaction)
+    except csv.Error, e:
+        return [], lineNumber + reader.line_num
+
+    # plain tuples pickle several times faster than Transactions
+    return map(tuple, rows), None
+
+def render_chunk(generatorClass, handlers, iif_types, filtered, groups):
+    """ Worker process side of IIFGenerator.render_parallel """
+    generator = generatorClass(None, None)
+    generator.handlers, generator.iif_types = handlers, iif_types
+    generator.filtered = filtered
+    f = cStringIO.StringIO()
+    failures = []
+    sizes = []
+    for transId, transactions in groups:
+        try:
+            trans, splits = generator.decipher_transactions(transactions)
+        except (ParseError, NotImplementedError, VoidError), e:
+            failures.append((transId, e))
+            continue
+        generator.write_transaction(trans, splits, f)
+        sizes.append((transId, len(splits)))
+    return f.getvalue(), failures, sizes, generator.recreated
+
+def get_compression(filename):
+    """ Return the compression of a file from its first bytes, or from its
+    extension if it does not exist yet, None if it is not compressed """
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            start = f.read(6)
+        for compression, magic in COMPRESSION_MAGIC:
+            if start.startswith(magic):
+                return compression
+        return None
+    return get_extension_compression(filename)
+
+def get_extension_compression(filename):
+    """ Return the compression an output file should get from its extension """
+    ext = os.path.splitext(filename)[1].lower()
+    for compression, compressionExt in COMPRESSION_EXTENSIONS.iteritems():
+        if ext == compressionExt:
+            return compression
+    return None
+
+def get_lzma():
+    # xz support is optional, it comes with python 3 or the backports.lzma package
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ValueError('xz compressed files need the lzma module (pip install backports.lzma)')
+    return lzma
+
+def open_input(filename):
+    """ Open a file for reading, decompressing it if it is compressed """
+    compression = get_compression(filename)
+    if compression == 'gz':
+        # reading lines from a GzipFile is much faster through a buffer
+        return io.BufferedReader(gzip.open(filename, 'rb'))
+    if compression == 'bz2':
+        return bz2.BZ2File(filename, 'r')
+    if compression == 'xz':
+        return get_lzma().LZMAFile(filename, 'rb')
+    # binary like the memory map the parallel parser reads, as the csv module
+    # wants, so a quoted field keeps its line endings whichever parser reads it
+    return open(filename, 'rb')
+
+def open_output(filename, compression=None):
+    """ Open a file for writing, compressing it with gz, bz2 or xz if asked to """
+    if compression == 'gz':
+        return gzip.open(filename, 'wb')
+    if compression == 'bz2':
+        return bz2.BZ2File(filename, 'w')
+    if compression == 'xz':
+        return get_lzma().LZMAFile(filename, 'wb')
+    return open(filename, 'w')
+
+def get_base_filename(filename):
+    """ Return filename without its compression and type extensions, so
+    both ledger.2008.csv and ledger.2008.csv.gz give ledger.2008 """
+    root, ext = os.path.splitext(filename)
+    if ext.lower() in COMPRESSION_EXTENSIONS.values():
+        root, ext = os.path.splitext(root)
+    return root
+
+def get_output_filename(filename, ext, compression=None):
     # keep the same filename, just swap the extension
-    dir_, file_ = os.path.split(filename)
-    file_, ext = file_.split('.')
-    return os.path.join(dir_, file_ + '.iif')
-
-def get_log_writer(filename):
-    dir_, file_ = os.path.split(filename)
-    file_, ext = file_.split('.')
-    new_filename = os.path.join(dir_, file_ + '.log')
-    open_file = open(new_filename, 'w')
+    return get_base_filename(filename) + ext + COMPRESSION_EXTENSIONS.get(compression, '')
+
+def get_iif_filename(filename, compression=None):
+    return get_output_filename(filename, '.iif', compression)
+
+def get_delta_filename(filename, compression=None):
+    return get_output_filename(filename, '.delta.iif', compression)
+
+def get_index_filename(filename):
+    # the index sits next to the iif file it describes
+    return get_iif_filename(filename) + '.index'
+
+def get_checkpoint_filename(filename):
+    return get_iif_filename(filename) + '.checkpoint'
+
+def get_stats_filename(filename):
+    return get_output_filename(filename, '.stats.json')
+
+def get_log_writer(filename, compression=None):
+    open_file = open_output(get_output_filename(filename, '.log', compression), compression)
     def logfile_writer(message):
         open_file.write('%s\n\n' % message)
+    logfile_writer.close = open_file.close
     return logfile_writer
 
 
-if __name__ == '__main__':
+def convert_file(filename, log_writer, stream=False, max_rows=DEFAULT_MAX_ROWS, processes=None, statistics=False,
+                 incremental=False, index_filename=None, parse_processes=None, progress=None, row_filter=None,
+                 atomic=False, compression=None, cache=None, checkpoint_rows=None, resume=False):
+    """ Convert a quickbooks export to an iif file, returning the name of the iif file.
+    An incremental conversion only writes the transactions that are not in the
+    index yet, or have changed, to a .delta.iif file.  If the conversion is
+    cancelled through progress the partly written iif file is removed.  Only
+    the rows chosen by row_filter are converted.  An atomic conversion leaves
+    any previous iif file in place until the new one is complete.  The input
+    may be compressed, and the iif file is compressed if compression is given.
+    The parsed rows are read from and stored in the ParseCache cache if given.
+    With checkpoint_rows, or resume, the file is converted serially while a
+    checkpoint is saved every checkpoint_rows rows, and resume continues an
+    interrupted conversion from its last checkpoint. """
+    checkpoint = None
+    if checkpoint_rows or resume:
+        if incremental or compression or get_compression(filename) is not None:
+            raise ValueError('checkpoints can not be used with incremental conversions or compressed files')
+        checkpoint = Checkpoint(get_checkpoint_filename(filename), checkpoint_rows or DEFAULT_CHECKPOINT_ROWS, resume)
+
+    stats = ConversionStats() if statistics else None
+    parser = FileParser(filename, log_writer, stats, parse_processes, row_filter, cache)
 
-    # get file to open
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
+    # find filename of the iif file to write
+    if incremental:
+        iif_filename = get_delta_filename(filename, compression)
+        index = TransactionIndex(index_filename or get_index_filename(filename))
+        generator = IncrementalIIFGenerator(iif_filename, log_writer, stats, index)
     else:
-        filename = UI.get_filename()
+        iif_filename = get_iif_filename(filename, compression)
+        generator = IIFGenerator(iif_filename, log_writer, stats)
+    parser.progress = generator.progress = progress
+    generator.atomic = atomic
+    generator.compression = compression
+    generator.filtered = row_filter is not None
 
-    # get error message window
-    message_window = MessageWindow()
+    try:
+        if checkpoint is not None:
+            generator.generate_checkpointed(parser, checkpoint, max_rows)
+        elif stream:
+            generator.generate_streaming(parser, max_rows, processes)
+        else:
+            generator.generate(parser.parse_file(), processes)
+    except Cancelled:
+        # a cancelled conversion is not resumed, so its checkpoint goes too
+        if checkpoint is not None:
+            checkpoint.remove()
+        raise
+
+    if incremental:
+        index.save()
+
+    if stats is not None:
+        stats.report(log_writer)
+        stats.write_json(get_stats_filename(filename))
+
+    return iif_filename
+
+def convert_merged(filenames, iif_filename, log_writer, max_rows=DEFAULT_MAX_ROWS, processes=None, statistics=False,
+                   parse_processes=None, row_filter=None, atomic=False, compression=None, cache=None):
+    """ Convert several quickbooks exports, for example monthly slices of one
+    ledger, to a single iif file """
+    stats = ConversionStats() if statistics else None
+    parsers = [ FileParser(filename, log_writer, stats, parse_processes, row_filter, cache) for filename in filenames ]
+
+    generator = IIFGenerator(iif_filename, log_writer, stats)
+    generator.atomic = atomic
+    generator.compression = compression
+    generator.filtered = row_filter is not None
+    generator.generate_merged(parsers, max_rows, processes)
+
+    if stats is not None:
+        stats.report(log_writer)
+        stats.write_json(get_stats_filename(iif_filename))
+
+    return iif_filename
+
+# exit codes used by the batch converter
+EXIT_OK, EXIT_PARSE_ERROR, EXIT_ERROR = 0, 1, 2
+
+def convert_batch_file(job):
+    """ Convert one file of a batch, returning (filename, exit code, message) """
+    filename, settings = job
+    log_writer = LogWriter()
+    try:
+        log_writer = LogWriter(get_log_writer(filename, settings.get('compression')))
+        iif_filename = convert_file(filename, log_writer, **settings)
+        log_writer.write('File created: %s' % iif_filename)
+    except ParseError, e:
+        return filename, EXIT_PARSE_ERROR, 'could not be parsed, see the log file'
+    except Exception, e:
+        return filename, EXIT_ERROR, '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        log_writer.close()
+    return filename, EXIT_OK, iif_filename
+
+def find_export_files(paths):
+    """ Expand any directories in paths to the csv files, compressed or not, they contain """
+    extensions = tuple([ '.csv' + ext for ext in COMPRESSION_EXTENSIONS.values() ] + ['.csv'])
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                    if name.lower().endswith(extensions)))
+        else:
+            filenames.append(path)
+    return filenames
+
+def convert_batch(paths, jobs=None, out=sys.stdout, **settings):
+    """ Convert many exports without a gui, spreading them over jobs worker
+    processes.  settings are passed on to convert_file.  Prints a summary
+    and returns the worst exit code. """
+    filenames = find_export_files(paths)
+    work = [ (filename, settings) for filename in filenames ]
+
+    if jobs == 1 or len(work) < 2:
+        results = map(convert_batch_file, work)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(convert_batch_file, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    exitCode = EXIT_OK
+    for filename, code, message in results:
+        out.write('%s\t%s\t%s\n' % (code, filename, message))
+        exitCode = max(exitCode, code)
+
+    converted = len([ result for result in results if result[1] == EXIT_OK ])
+    out.write('Converted %s of %s files\n' % (converted, len(results)))
+    return exitCode
+
+def convert_merge(paths, iif_filename, out=sys.stdout, **settings):
+    """ Merge many exports into one iif file without a gui.  settings are
+    passed on to convert_merged.  Prints a summary and returns the exit code. """
+    filenames = find_export_files(paths)
+    if settings.get('compression') is None:
+        settings['compression'] = get_extension_compression(iif_filename)
+    log_writer = LogWriter()
+    try:
+        log_writer = LogWriter(get_log_writer(iif_filename, settings['compression']))
+        convert_merged(filenames, iif_filename, log_writer, **settings)
+    except ParseError, e:
+        out.write('%s\tcould not be merged, see the log file\n' % iif_filename)
+        return EXIT_PARSE_ERROR
+    except Exception, e:
+        out.write('%s\t%s: %s\n' % (iif_filename, e.__class__.__name__, e))
+        return EXIT_ERROR
+    finally:
+        log_writer.close()
+
+    out.write('Merged %s files into %s\n' % (len(filenames), iif_filename))
+    return EXIT_OK
+
+def list_accounts(paths, out=sys.stdout):
+    """ Print the account hierarchy of each export with the number of rows
+    directly under each account and including its subaccounts """
+    def error_writer(filename):
+        # leave the log file of the last conversion alone
+        return lambda message: out.write('%s\t%s\n' % (filename, message))
+
+    exitCode = EXIT_OK
+    for filename in find_export_files(paths):
+        try:
+            accounts = FileParser(filename, LogWriter(error_writer(filename))).account_index()
+        except ParseError, e:
+            exitCode = EXIT_PARSE_ERROR
+            continue
+
+        totals = collections.defaultdict(int)
+        for path, rows in accounts.iteritems():
+            for depth in xrange(len(path) + 1):
+                totals[path[:depth]] += rows
+
+        out.write('%s\n' % filename)
+        for path, rows in accounts.iteritems():
+            if path:
+                out.write('%8d %8d  %s%s\n' % (rows, totals[path], '  ' * (len(path) - 1), path[-1]))
+        out.write('%8d %8d  total\n' % (accounts.get((), 0), totals[()]))
+    return exitCode
+
+def convert_in_background(filename, log_writer, progress, settings):
+    """ Thread side of gui_main, leaving the exit code in progress.result
+    and putting ('done', code) on the updates queue once the conversion has
+    finished """
+    code = EXIT_ERROR
+    try:
+        iif_filename = convert_file(filename, log_writer, progress=progress, **settings)
+        log_writer.write('File created: %s' % iif_filename)
+        code = EXIT_OK
+    except Cancelled:
+        log_writer.write('Conversion cancelled, no file was created')
+    except ParseError, e:
+        code = EXIT_PARSE_ERROR
+    except Exception, e:
+        log_writer.write('Conversion failed: %s: %s' % (e.__class__.__name__, e))
+    finally:
+        progress.result = code
+        progress.updates.put(('done', code))
+
+def gui_main(filename, **settings):
+    # get file to open
+    if not filename:
+        filename = get_ui().get_filename()
 
     # if not file was specified exit
     if not filename:
+        message_window = MessageWindow()
         message_window.insert('No file to convert, quitting ...')
         message_window.show()
-        sys.exit(1)
+        return 1
 
-    # create logfile writer function
-    logfile_writer = get_log_writer(filename)
+    # the conversion runs on its own thread, and only talks to the window
+    # through the updates queue
+    updates = Queue.Queue()
+    progress = ConversionProgress(updates)
+    message_window = MessageWindow(progress.cancel)
 
     # create log_writer instance that will write log messages to both the message window and the log file
-    log_writer = LogWriter(message_window.insert, logfile_writer)
+    log_writer = LogWriter(progress.message, get_log_writer(filename, settings.get('compression')))
 
-    # find filename of the iif file to write
-    iif_filename = get_iif_filename(filename)
-
-    try:
-        # find the files transactions and index by i
-        transactions = FileParser(filename, log_writer).parse_file()
+    worker = threading.Thread(target=convert_in_background, args=(filename, log_writer, progress, settings))
+    worker.start()
+    message_window.poll(updates)
+    message_window.show()
 
-        # generate the iif file
-        IIFGenerator(iif_filename, log_writer).generate(transactions)
+    # closing the window before the conversion is done cancels it
+    progress.cancel()
+    worker.join()
+    log_writer.close()
+    return progress.result
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [export.csv ...]')
+    parser.add_option('-b', '--batch', action='store_true', default=False,
+                      help='convert the given files and directories without a gui')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='number of worker processes used in batch mode (default: one per cpu)')
+    parser.add_option('-s', '--stream', action='store_true', default=False,
+                      help='write transactions while the file is read instead of loading it all first')
+    parser.add_option('--max-rows', type='int', default=DEFAULT_MAX_ROWS,
+                      help='rows kept in memory when streaming before spilling to disk (default: %default)')
+    parser.add_option('-w', '--workers', type='int', default=None,
+                      help='worker processes used to decipher and write the transactions of one file')
+    parser.add_option('-p', '--parse-workers', type='int', default=None,
+                      help='worker processes used to parse chunks of one memory mapped file')
+    parser.add_option('--statistics', action='store_true', default=False,
+                      help='log the time taken by each stage and write it to a .stats.json file')
+    parser.add_option('-i', '--incremental', action='store_true', default=False,
+                      help='only write transactions that are new or changed since the last incremental run, '
+                           'to a .delta.iif file')
+    parser.add_option('-m', '--merge', metavar='IIF',
+                      help='merge the given files and directories, which may overlap, into this one iif file without a gui')
+    parser.add_option('-a', '--account', action='append', default=[], metavar='PATTERN',
+                      help='only convert the rows of accounts matching this glob, or of its subaccounts (may be repeated)')
+    parser.add_option('--exclude-account', action='append', default=[], metavar='PATTERN',
+                      help='skip the rows of accounts matching this glob, or of its subaccounts (may be repeated)')
+    parser.add_option('--from', dest='start', metavar='DATE', help='skip rows dated before this yyyy-mm-dd date')
+    parser.add_option('--to', dest='end', metavar='DATE', help='skip rows dated after this yyyy-mm-dd date')
+    parser.add_option('-t', '--type', action='append', default=[],
+                      help='only convert transactions of this type (may be repeated)')
+    parser.add_option('--exclude-type', action='append', default=[], help='skip transactions of this type (may be repeated)')
+    parser.add_option('--list-accounts', action='store_true', default=False,
+                      help='print the accounts of the given files and their row counts instead of converting them')
+    parser.add_option('--atomic', action='store_true', default=False,
+                      help='write to a temporary file and only replace the iif file once it is complete')
+    parser.add_option('-z', '--compress', type='choice', choices=sorted(COMPRESSION_EXTENSIONS),
+                      help='compress the iif and log files with gz, bz2 or xz (compressed input is always detected)')
+    parser.add_option('--cache', metavar='DIR',
+                      help='keep the parsed rows of each export in this directory, so converting it again skips parsing')
+    parser.add_option('--cache-size', type='int', default=DEFAULT_CACHE_SIZE >> 20, metavar='MB',
+                      help='size of the --cache directory beyond which the least recently used entries are removed '
+                           '(default: %default)')
+    parser.add_option('--serve', metavar='[HOST:]PORT',
+                      help='run a conversion service on this port of localhost, with --jobs worker processes')
+    parser.add_option('--allow-remote', action='store_true', default=False,
+                      help='let --serve listen on an address other than localhost, which lets anyone who can reach it '
+                           'convert any file the service can read')
+    parser.add_option('--server', metavar='[HOST:]PORT',
+                      help='convert the given files and directories on a running conversion service')
+    parser.add_option('--upload', action='store_true', default=False,
+                      help='send the files to the --server instead of having it read them')
+    parser.add_option('--checkpoint', type='int', metavar='ROWS',
+                      help='convert serially, saving a checkpoint every ROWS rows that --resume can continue from')
+    parser.add_option('--resume', action='store_true', default=False,
+                      help='continue an interrupted conversion from its last checkpoint, or start one with checkpoints '
+                           '(every %d rows unless --checkpoint is given)' % DEFAULT_CHECKPOINT_ROWS)
+    parser.add_option('--index', help='index file used by --incremental (default: the .iif filename + .index)')
+    options, args = parser.parse_args(argv)
+
+    if options.incremental and options.workers > 1:
+        parser.error('--incremental can not be combined with --workers')
+    if options.index and options.batch and options.jobs != 1:
+        parser.error('a shared --index can only be used in batch mode together with --jobs 1')
+    if options.checkpoint is not None and options.checkpoint < 1:
+        parser.error('--checkpoint must be a positive number of rows')
+    if options.checkpoint or options.resume:
+        if options.incremental or options.compress or options.merge:
+            parser.error('--checkpoint and --resume can not be combined with --incremental, --compress or --merge')
+        if options.workers > 1 or options.parse_workers > 1:
+            parser.error('a conversion with checkpoints is serial, so --workers and --parse-workers can not be used')
+
+    if options.list_accounts:
+        if not args:
+            parser.error('no files to list')
+        return list_accounts(args)
+
+    rowFilter = None
+    if options.account or options.exclude_account or options.start or options.end or options.type or options.exclude_type:
+        try:
+            rowFilter = RowFilter(options.account, options.exclude_account, options.start, options.end,
+                                  options.type, options.exclude_type)
+        except ValueError, e:
+            parser.error(str(e))
+
+    parseCache = ParseCache(options.cache, options.cache_size << 20) if options.cache else None
+    settings = dict(stream=options.stream, max_rows=options.max_rows, processes=options.workers,
+                    statistics=options.statistics, incremental=options.incremental, index_filename=options.index,
+                    parse_processes=options.parse_workers, row_filter=rowFilter, atomic=options.atomic,
+                    compression=options.compress, cache=parseCache, checkpoint_rows=options.checkpoint,
+                    resume=options.resume)
+
+    # the service lives in its own module so that a plain conversion doesn't load the http modules
+    if options.serve:
+        if (options.workers > 1 or options.parse_workers > 1) and options.jobs != 1:
+            parser.error('--workers and --parse-workers can only be used by the service together with --jobs 1')
+        import qbservice
+        try:
+            return qbservice.serve(qbservice.parse_address(options.serve), settings, options.jobs,
+                                   allow_remote=options.allow_remote)
+        except ValueError, e:
+            parser.error(str(e))
+
+    if options.server:
+        if not args:
+            parser.error('no files to convert')
+        import qbservice
+        return qbservice.convert_remote(args, qbservice.parse_address(options.server), options.upload)
+
+    if options.merge:
+        if not args:
+            parser.error('no files to merge')
+        if options.incremental or options.batch:
+            parser.error('--merge can not be combined with --incremental or --batch')
+        return convert_merge(args, options.merge, max_rows=options.max_rows, processes=options.workers,
+                             statistics=options.statistics, parse_processes=options.parse_workers,
+                             row_filter=rowFilter, atomic=options.atomic, compression=options.compress, cache=parseCache)
+
+    if options.batch:
+        if not args:
+            parser.error('no files to convert')
+        if (options.workers > 1 or options.parse_workers > 1) and options.jobs != 1:
+            parser.error('--workers and --parse-workers can only be used in batch mode together with --jobs 1')
+        return convert_batch(args, options.jobs, **settings)
+
+    return gui_main(args[0] if args else None, **settings)
 
-    except ParseError, e:
-        message_window.show()
-        sys.exit(1)
 
-    # show log messages
-    log_writer.write('File created: %s' % iif_filename)
-    message_window.show()
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+""" A local conversion service, so that converting many small exports
+doesn't pay for starting python and loading the converter every time.
+
+Run it with qbexport.py --serve [HOST:]PORT and send it files with
+qbservice.py [--upload] [HOST:]PORT FILES, which doesn't load the converter
+itself, or with any http client:
+
+    POST /convert   {"path": "/exports/ledger.csv"}
+    POST /upload?name=ledger.csv   with the csv as the body
+    GET  /status
+
+Each returns json with the exit code, the iif filename and the log
+messages, and an upload's result also carries the iif text.
+
+The service converts any file it can read, so it only listens on localhost
+unless it is told otherwise.  A post has to carry the token the service
+writes to ~/.qbexport-service-PORT in an X-QBExport-Token header, with
+a json body for /convert, so a web page can't have the browser send one.
+"""
+
+from __future__ import with_statement
+import sys, os, json, tempfile, shutil, socket, urllib, urlparse, httplib, optparse, binascii, hmac, \
+    BaseHTTPServer, SocketServer
+
+# port of the conversion service on localhost
+DEFAULT_PORT = 8750
+
+# the exit codes of qbexport, so that the client doesn't have to load the converter
+EXIT_OK, EXIT_PARSE_ERROR, EXIT_ERROR = 0, 1, 2
+
+# header carrying the token of the service
+TOKEN_HEADER = 'X-QBExport-Token'
+
+# content types a web page can post without the browser asking the service first
+SIMPLE_CONTENT_TYPES = ('text/plain', 'application/x-www-form-urlencoded', 'multipart/form-data')
+
+def convert_service_job(filename, settings):
+    """ Convert one file for the conversion service, returning a result with
+    the exit code, the iif filename and the log messages """
+    from qbexport import LogWriter, ParseError, convert_file, get_log_writer
+    messages = []
+    # some messages are exceptions, which json can't carry
+    log = lambda message: messages.append(str(message))
+    log_writer = LogWriter(log)
+    result = {'code': EXIT_ERROR, 'iif_filename': None, 'messages': messages}
+    # nothing is written next to a path that isn't an export
+    if not os.path.isfile(filename):
+        messages.append('No such export file: %s' % filename)
+        return result
+    try:
+        log_writer = LogWriter(log, get_log_writer(filename, settings.get('compression')))
+        result['iif_filename'] = convert_file(filename, log_writer, **settings)
+        log_writer.write('File created: %s' % result['iif_filename'])
+        result['code'] = EXIT_OK
+    except ParseError, e:
+        result['code'] = EXIT_PARSE_ERROR
+    except Exception, e:
+        messages.append('%s: %s' % (e.__class__.__name__, e))
+    finally:
+        log_writer.close()
+    return result
+
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local http service that converts exports with everything already
+    loaded, so a conversion doesn't pay for starting python.
+
+    POST /convert with {"path": ...} converts a file on disk like the batch
+    converter does.  POST /upload?name=... converts the csv sent as the
+    body, and the result carries the iif text.  Each request is handled on
+    its own thread, and the conversions run on a pool of jobs worker
+    processes, or on the request's thread if jobs is 1.  A post is only
+    handled if it carries token, a random one unless it is given.  The
+    address has to be on localhost unless allow_remote is set.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, settings, jobs=None, allow_remote=False, token=None):
+        if not allow_remote and not is_loopback(address[0]):
+            raise ValueError('the conversion service only listens on localhost unless remote access is allowed, not on %r'
+                             % address[0])
+        BaseHTTPServer.HTTPServer.__init__(self, address, ConversionHandler)
+        self.settings = settings
+        self.token = token or binascii.hexlify(os.urandom(16))
+        self.pool = None
+        if jobs != 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(jobs)
+
+    def convert(self, filename):
+        if self.pool is None:
+            return convert_service_job(filename, self.settings)
+        return self.pool.apply(convert_service_job, (filename, self.settings))
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+class ConversionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # send each response in one piece and at once, or small requests spend
+    # most of their time waiting on delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_error(404)
+        self.send_json({'status': 'ok', 'pid': os.getpid()})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.getheader('content-length') or 0)
+        contentType = (self.headers.getheader('content-type') or '').split(';')[0].strip().lower()
+
+        if not hmac.compare_digest(self.headers.getheader(TOKEN_HEADER) or '', self.server.token):
+            return self.send_error(403, 'the %s header does not hold the token of the service' % TOKEN_HEADER)
+
+        if url.path == '/convert':
+            if contentType != 'application/json':
+                return self.send_error(415, 'expected an application/json body')
+            try:
+                filename = json.loads(self.rfile.read(length))['path']
+            except (ValueError, KeyError, TypeError):
+                return self.send_error(400, 'expected {"path": "export.csv"}')
+            self.send_json(self.server.convert(os.path.abspath(filename)))
+
+        elif url.path == '/upload':
+            if contentType in SIMPLE_CONTENT_TYPES:
+                return self.send_error(415, 'expected a text/csv body')
+            name = os.path.basename(urlparse.parse_qs(url.query).get('name', ['upload.csv'])[0]) or 'upload.csv'
+            directory = tempfile.mkdtemp()
+            try:
+                filename = os.path.join(directory, name)
+                with open(filename, 'wb') as f:
+                    while length > 0:
+                        data = self.rfile.read(min(length, 1 << 16))
+                        if not data:
+                            break
+                        f.write(data)
+                        length -= len(data)
+
+                result = self.server.convert(filename)
+                if result['iif_filename'] is not None:
+                    with open(result['iif_filename'], 'rb') as f:
+                        result['iif'] = f.read()
+                    result['iif_filename'] = os.path.basename(result['iif_filename'])
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            self.send_json(result)
+
+        else:
+            self.send_error(404)
+
+    def send_json(self, result):
+        # latin-1 carries the bytes of the export through json unchanged
+        data = json.dumps(result, encoding='latin-1')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # the results carry the log messages, so keep quiet
+        pass
+
+def parse_address(value):
+    """ Return (host, port) from host:port, port or host, defaulting to
+    localhost and DEFAULT_PORT """
+    host, sep, port = value.rpartition(':')
+    if not sep and not port.isdigit():
+        host, port = port, ''
+    return host or '127.0.0.1', int(port or DEFAULT_PORT)
+
+def is_loopback(host):
+    """ Whether host is an address of this machine only """
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(address[4][0].startswith('127.') or address[4][0] == '::1' for address in addresses)
+
+def get_token_filename(port):
+    """ The file holding the token of the service on port, which only its user can read """
+    return os.path.join(os.path.expanduser('~'), '.qbexport-service-%s' % port)
+
+def write_token(port, token):
+    filename = get_token_filename(port)
+    if os.path.exists(filename):
+        os.remove(filename)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return filename
+
+def read_token(port):
+    try:
+        with open(get_token_filename(port)) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+def serve(address, settings, jobs=None, out=sys.stdout, allow_remote=False):
+    """ Run the conversion service until it is interrupted """
+    server = ConversionServer(address, settings, jobs, allow_remote)
+    tokenFilename = write_token(server.server_address[1], server.token)
+    out.write('Serving conversions on http://%s:%s/\n' % server.server_address)
+    out.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(tokenFilename)
+    return EXIT_OK
+
+def read_result(response):
+    """ The result of a conversion from the service's response, or an error result if it refused the request """
+    data = response.read()
+    if response.status != httplib.OK:
+        return {'code': EXIT_ERROR, 'iif_filename': None,
+                'messages': [u'The service refused the request: %s %s' % (response.status, response.reason)]}
+    return json.loads(data, encoding='latin-1')
+
+def convert_remote(paths, address, upload=False, out=sys.stdout, token=None):
+    """ Convert exports on a running conversion service.  Files are
+    converted where they are, or sent to the service and the iif file
+    written next to them if upload is set.  The token is read from the file
+    the service wrote if it isn't given.  Prints a summary like
+    convert_batch and returns the worst exit code.  The converter is only
+    loaded to find the exports in a directory, or to write an upload's log. """
+    if upload or any(os.path.isdir(path) for path in paths):
+        from qbexport import LogWriter, find_export_files, get_log_writer
+        filenames = find_export_files(paths)
+    else:
+        filenames = list(paths)
+    if token is None:
+        token = read_token(address[1])
+    connection = httplib.HTTPConnection(*address)
+    exitCode = EXIT_OK
+    converted = 0
+    try:
+        # an upload's headers and body go out separately, don't let them wait on each other
+        connection.connect()
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        for filename in filenames:
+            if upload:
+                with open(filename, 'rb') as f:
+                    connection.request('POST', '/upload?' + urllib.urlencode({'name': os.path.basename(filename)}), f,
+                                       {'Content-Type': 'text/csv', 'Content-Length': str(os.fstat(f.fileno()).st_size),
+                                        TOKEN_HEADER: token})
+                    result = read_result(connection.getresponse())
+            else:
+                connection.request('POST', '/convert', json.dumps({'path': os.path.abspath(filename)}),
+                                   {'Content-Type': 'application/json', TOKEN_HEADER: token})
+                result = read_result(connection.getresponse())
+
+            # back to the bytes the service read from the export
+            messages = [ message.encode('latin-1') for message in result['messages'] ]
+            iif_filename = result['iif_filename'] and result['iif_filename'].encode('latin-1')
+
+            # the service converted a copy, so keep its iif and log here
+            if upload:
+                if iif_filename is not None:
+                    iif_filename = os.path.join(os.path.dirname(filename), iif_filename)
+                    with open(iif_filename, 'wb') as f:
+                        f.write(result['iif'].encode('latin-1'))
+                log_writer = LogWriter(get_log_writer(filename))
+                for message in messages:
+                    log_writer.write(message)
+                log_writer.close()
+
+            code = result['code']
+            if code == EXIT_OK:
+                converted += 1
+                message = iif_filename
+            else:
+                message = messages[-1] if messages else 'could not be converted'
+            out.write('%s\t%s\t%s\n' % (code, filename, message))
+            exitCode = max(exitCode, code)
+    finally:
+        connection.close()
+
+    out.write('Converted %s of %s files\n' % (converted, len(filenames)))
+    return exitCode
+
+def main():
+    parser = optparse.OptionParser(usage='usage: %prog [options] [HOST:]PORT FILE_OR_DIRECTORY...',
+                                   description='Convert quickbooks exports on a conversion service started with '
+                                               'qbexport.py --serve.')
+    parser.add_option('--upload', action='store_true', default=False,
+                      help='send the files to the service instead of having it read them')
+    parser.add_option('--token',
+                      help='token of the service, read from ~/.qbexport-service-PORT if not given')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('a service address and files to convert are needed')
+    return convert_remote(args[1:], parse_address(args[0]), options.upload, token=options.token)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,38 @@
 import unittest
 from qbexport import *
+from qbservice import ConversionServer, convert_remote, parse_address, is_loopback
+import qbservice
 from decimal import Decimal
 import StringIO
+import os, shutil, tempfile, Queue, gzip, bz2, threading, cPickle, random, httplib, json
+
+SAMPLE_CSV = """\
+,Trans #,Type,Date,Num,Name,Memo,Clr,Split,Debit,Credit,Balance
+Checking,,,,,,,,,,,
+,1,Check,1/5/2008,101,Acme,,,Expenses:Office,,100.00,-100.00
+,2,Check,1/6/2008,102,Bell,,,-SPLIT-,,75.50,-175.50
+,3,Deposit,1/7/2008,,Customer,,,Income,250.00,,74.50
+,4,Transfer,1/8/2008,,,,,Savings,,20.00,54.50
+,5,Check,1/9/2008,103,Void Co,VOID,,Expenses:Office,,0.00,54.50
+Total Checking,,,,,,,,,250.00,195.50,54.50
+Expenses,,,,,,,,,,,
+Office,,,,,,,,,,,
+,1,Check,1/5/2008,101,Acme,,,Checking,100.00,,100.00
+,2,Check,1/6/2008,102,Bell,,,Checking,50.00,,150.00
+,5,Check,1/9/2008,103,Void Co,VOID,,Checking,0.00,,150.00
+Total Office,,,,,,,,,150.00,,150.00
+Phone,,,,,,,,,,,
+,2,Check,1/6/2008,102,Bell,,,Checking,25.50,,25.50
+Total Phone,,,,,,,,,25.50,,25.50
+Total Expenses,,,,,,,,,175.50,,175.50
+Income,,,,,,,,,,,
+,3,Deposit,1/7/2008,,Customer,,,Checking,,250.00,-250.00
+Total Income,,,,,,,,,,250.00,-250.00
+Savings,,,,,,,,,,,
+,4,Transfer,1/8/2008,,,,,Checking,20.00,,20.00
+Total Savings,,,,,,,,,20.00,,20.00
+TOTAL,,,,,,,,,445.50,445.50,0.00
+"""
 
 class MessageWindow(object):
     def insert(self):
@@ -152,6 +183,734 @@ ENDTRNS
         self.assertTrue(splits[0]['AccountName'] == ['split'])
         self.assertRaises(ParseError, generator.decipher_transactions, transactionMap['109'])
 
+    def testTransactionRecord(self):
+        fileparser = FileParser('test', None)
+        columns = ['AccountName', 'Trans #', 'Type', 'Date', 'Name', 'Memo', 'Split', 'Amount', 'Balance']
+        fileparser.get_data_row(('Checking', '', '', '', '', '', '', '', ''), columns)
+        first = fileparser.get_data_row(('', '7', 'Check', '1/2/2008', 'Acme', '', 'Office', '-5.00', '10.00'), columns)
+        second = fileparser.get_data_row(('', '8', 'Check', '1/3/2008', 'Acme', '', 'Office', '-6.00', '4.00'), columns)
+
+        self.assertTrue(isinstance(first, Transaction))
+        self.assertTrue(first['AccountName'] is second['AccountName'])
+        self.assertEqual(first['AccountName'], ('Checking',))
+        self.assertEqual(first['Num'], '')
+        self.assertEqual(first['Amount'], -500)
+        self.assertEqual(first.get('Balance'), None)
+        self.assertEqual(first.replace(Amount=Decimal(5))['Amount'], Decimal(5))
+        self.assertEqual(cPickle.loads(cPickle.dumps(first, 2)), first)
+
+
+# quoted fields spanning lines, including ones that look like account headers
+# accounts in an order that isn't alphabetical, so the rows of a group in
+# file order are not in the order of their content
+UNSORTED_CSV = """\
+,Trans #,Type,Date,Num,Name,Memo,Clr,Split,Debit,Credit,Balance
+Zions Checking,,,,,,,,,,,
+,7,General Journal,1/2/2008,,,,,Advertising,,100.00,-100.00
+,8,Check,1/3/2008,104,Zed,,,-SPLIT-,,30.00,-130.00
+Total Zions Checking,,,,,,,,,,130.00,-130.00
+Office,,,,,,,,,,,
+,8,Check,1/3/2008,104,Zed,,,Zions Checking,20.00,,20.00
+Total Office,,,,,,,,,20.00,,20.00
+Advertising,,,,,,,,,,,
+,7,General Journal,1/2/2008,,,,,Zions Checking,100.00,,100.00
+,8,Check,1/3/2008,104,Zed,,,Zions Checking,10.00,,110.00
+Total Advertising,,,,,,,,,110.00,,110.00
+"""
+
+MULTILINE_CSV = '''\
+,Trans #,Type,Date,Num,Name,Memo,Clr,Split,Debit,Credit,Balance
+"Checking, main",,,,,,,,,,,
+,1,Check,1/5/2008,101,Acme,"first line
+Total Checking, main
+third line",,Office,,100.00,-100.00
+,2,Check,1/6/2008,102,"Bell
+Savings",,,Office,,75.50,-175.50
+Office,,,,,,,,,,,
+,1,Check,1/5/2008,101,Acme,"""",,"Checking, main",100.00,,100.00
+,2,Check,1/6/2008,102,Bell,"a ""quoted""
+ memo",,"Checking, main",75.50,,175.50
+Total Office,,,,,,,,,175.50,,175.50
+Total "Checking, main",,,,,,,,,,,
+Savings,,,,,,,,,,,
+,3,Deposit,1/7/2008,,"Customer
+",,,Income,250.00,,250.00
+Total Savings,,,,,,,,,,,
+TOTAL,,,,,,,,,,,
+'''
+
+# the iif file written for SAMPLE_CSV, which must not change byte for byte
+SAMPLE_IIF = ''.join([
+    '!TRNS\tTRNSID\tTRNSTYPE\tDATE\tACCNT\tNAME\tAMOUNT\tDOCNUM\tMEMO\tCLEAR\tTOPRINT\tADDR1\tADDR2' + '\t' * 32 + '\n',
+    '!SPL\tSPLID\tTRNSTYPE\tDATE\tACCNT\tNAME\tAMOUNT\tDOCNUM\tMEMO\tCLEAR\tQNTY' + '\t' * 34 + '\n',
+    '!ENDTRNS\n',
+    'TRNS\t\tCheck\t1/5/2008\tChecking\tAcme\t-100.00\t101\t\tN\tN' + '\t' * 34 + '\n',
+    'SPL\t\tCheck\t1/5/2008\tExpenses:Office\tAcme\t100.00\t101\t\tN' + '\t' * 35 + '\n',
+    'ENDTRNS\n',
+    'TRNS\t\tCheck\t1/6/2008\tChecking\tBell\t-75.50\t102\t\tN\tN' + '\t' * 34 + '\n',
+    'SPL\t\tCheck\t1/6/2008\tExpenses:Office\tBell\t50.00\t102\t\tN' + '\t' * 35 + '\n',
+    'SPL\t\tCheck\t1/6/2008\tExpenses:Phone\tBell\t25.50\t102\t\tN' + '\t' * 35 + '\n',
+    'ENDTRNS\n',
+    'TRNS\t\tDeposit\t1/7/2008\tChecking\tCustomer\t250.00\t\t\tN\tN' + '\t' * 34 + '\n',
+    'SPL\t\tDeposit\t1/7/2008\tIncome\tCustomer\t-250.00\t\t\tN' + '\t' * 35 + '\n',
+    'ENDTRNS\n',
+    'TRNS\t\tTRANSFER\t1/8/2008\tChecking\t\t-20.00\t\t\tN\tN' + '\t' * 34 + '\n',
+    'SPL\t\tTRANSFER\t1/8/2008\tSavings\t\t20.00\t\t\tN' + '\t' * 35 + '\n',
+    'ENDTRNS\n',
+])
+
+
+class DecimalFileParser(FileParser):
+    """ The parser as it was before amounts were held as integer cents """
+    def get_amount(self, value):
+        return self.get_decimal(value)
+
+class TestMoney(unittest.TestCase):
+
+    edgeCases = ['', '0', '0.00', '-0.00', '-0', '0.0', '5', '5.0', '5.00', '-5.00', '.50', '-.50', '007.50',
+                 '+5.00', ' 5.00', '5.00 ', '1,234.56', '-1,234.56', '1e3', '5.001', '5.', 'abc', '--5.00', '-',
+                 '12345678901234567890.99', '-12345678901234567890.99', '0.05', '-0.05']
+
+    def setUp(self):
+        self.random = random.Random(1234)
+        self.parser = FileParser('test', None)
+
+    def random_amount(self):
+        whole = self.random.choice(['0', str(self.random.randint(0, 10)), str(self.random.randint(0, 10 ** 9)),
+                                    '{0:,}'.format(self.random.randint(1000, 10 ** 7))])
+        fraction = self.random.choice(['', '.', '.5', '.%02d' % self.random.randint(0, 99), '.%03d' % self.random.randint(0, 999)])
+        return self.random.choice(['', '-', '+']) + whole + fraction
+
+    def amounts(self):
+        return self.edgeCases + [ self.random_amount() for i in xrange(2000) ]
+
+    def testFormatMatchesDecimal(self):
+        for value in self.amounts():
+            amount = self.parser.get_amount(value)
+            decimal = self.parser.get_decimal(value)
+            self.assertEqual('%s' % format_amount(amount), '%s' % decimal, value)
+            self.assertEqual('%s' % format_amount(-amount), '%s' % -decimal, value)
+            self.assertEqual(bool(amount), bool(decimal), value)
+            self.assertEqual(amount < 0, decimal < 0, value)
+            self.assertEqual(to_decimal(amount), decimal, value)
+
+    def testSumMatchesDecimal(self):
+        values = self.amounts()
+        for i in xrange(500):
+            sample = self.random.sample(values, self.random.randint(1, 6))
+            amounts = [ self.parser.get_amount(value) for value in sample ]
+            decimals = [ self.parser.get_decimal(value) for value in sample ]
+            self.assertEqual(to_decimal(sum_amounts(amounts)), sum(decimals), sample)
+            self.assertTrue(amounts_equal(sum_amounts(amounts), sum(decimals)), sample)
+
+    def testIifMatchesDecimal(self):
+        lines = [',Trans #,Type,Date,Num,Name,Memo,Clr,Split,Debit,Credit,Balance', 'Checking,,,,,,,,,,,']
+        for transId, value in enumerate(self.amounts()):
+            tType = self.random.choice(['Check', 'Deposit'])
+            debit, credit = (value, '') if tType == 'Deposit' else ('', value)
+            lines.append(',%s,%s,1/1/2008,,Payee,,,Expenses,"%s","%s",' % (transId, tType, debit, credit))
+        lines.extend(['Total Checking,,,,,,,,,,,', 'TOTAL,,,,,,,,,,,', ''])
+
+        directory = tempfile.mkdtemp()
+        try:
+            csvFile = os.path.join(directory, 'amounts.csv')
+            with open(csvFile, 'w') as f:
+                f.write('\n'.join(lines))
+
+            outputs = []
+            for parserClass in (FileParser, DecimalFileParser):
+                messages = []
+                log_writer = LogWriter(messages.append)
+                iifFile = os.path.join(directory, parserClass.__name__ + '.iif')
+                IIFGenerator(iifFile, log_writer).generate(parserClass(csvFile, log_writer).parse_file())
+                with open(iifFile) as f:
+                    outputs.append((f.read(), messages))
+
+            self.assertEqual(outputs[0], outputs[1])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.csv = os.path.join(self.dir, 'sample.csv')
+        with open(self.csv, 'w') as f:
+            f.write(SAMPLE_CSV)
+        self.messages = []
+        self.log_writer = LogWriter(self.messages.append)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def testGroupTransactionsSpill(self):
+        rows = FileParser(self.csv, self.log_writer).parse_file()
+        counts = count_transactions(rows)
+        inMemory = list(group_transactions(rows, counts))
+        spilled = list(group_transactions(rows, counts, max_rows=1))
+        self.assertEqual([transId for transId, group in inMemory], ['1', '5', '2', '3', '4'])
+        self.assertEqual(inMemory, spilled)
+
+    def testHandlers(self):
+        rows = FileParser(self.csv, self.log_writer).parse_file()
+        groups = dict(group_transactions(rows, count_transactions(rows)))
+        generator = IIFGenerator(None, self.log_writer)
+
+        trans, splits = generator.decipher_transactions(groups['4'])
+        self.assertEqual((trans['AccountName'], trans['Amount']), (('Checking',), -2000))
+        self.assertEqual([ (spl['AccountName'], spl['Amount']) for spl in splits ], [(('Savings',), 2000)])
+        f = StringIO.StringIO()
+        generator.write_transaction(trans, splits, f)
+        self.assertTrue(f.getvalue().startswith('TRNS\t\tTRANSFER\t1/8/2008\tChecking\t'))
+
+        journal = [ row.replace(Type='General Journal') for row in groups['2'] ]
+        trans, splits = generator.decipher_transactions(journal)
+        self.assertEqual(trans, journal[0])
+        self.assertEqual(len(splits), 2)
+
+        estimate = [ row.replace(Type='Estimate') for row in groups['1'] ]
+        self.assertRaises(NotImplementedError, generator.decipher_transactions, estimate)
+        self.assertRaises(VoidError, generator.decipher_transactions, [ row.replace(Type='Estimate') for row in groups['5'] ])
+
+        generator.handlers = dict(IIFGenerator.handlers, Estimate=split_outgoing)
+        trans, splits = generator.decipher_transactions(estimate)
+        self.assertEqual(trans['Amount'], -10000)
+
+    def testGroupSummary(self):
+        rows = FileParser(self.csv, self.log_writer).parse_file()
+        groups = dict(group_transactions(rows, count_transactions(rows)))
+        summary = GroupSummary(groups['2'])
+        self.assertEqual(summary.negative, [groups['2'][0]])
+        self.assertEqual(summary.positive, groups['2'][1:])
+        self.assertEqual((summary.amount_sum(summary.positive), summary.amount_sum(summary.negative)), (7550, -7550))
+        self.assertEqual(summary.amount_sum(groups['2'][:2]), -2550)
+        self.assertEqual((summary.void, GroupSummary(groups['5']).void), (False, True))
+        self.assertEqual(GroupSummary([ dict(row.iteritems()) for row in groups['2'] ]).positive,
+                         [ dict(row.iteritems()) for row in groups['2'][1:] ])
+
+        # groups that fail validation are reported with what the summary found
+        generator = IIFGenerator(os.path.join(self.dir, 'sample.iif'), self.log_writer)
+        try:
+            generator.decipher_transactions(groups['2'][:2])
+            self.fail('an unbalanced transaction was deciphered')
+        except ParseError, e:
+            self.assertTrue('(-75.50 against 50.00; 2 rows, 1 positive totalling 50.00, 1 negative totalling -75.50)' in str(e))
+        twice = [ row.replace(Amount=-100) for row in groups['1'] ]
+        self.assertRaises(AmbiguousError, generator.decipher_transactions, twice)
+
+        # failures are listed in numeric order, and a Trans # that isn't a number doesn't stop the log
+        f = StringIO.StringIO()
+        voids = [ [ row.replace(**{'Trans #': transId}) for row in groups['5'] ] for transId in ('10', '9', 'A1') ]
+        generator.write_groups([ (group[0]['Trans #'], group) for group in voids ] + [('5', groups['5'])])
+        self.assertTrue(self.messages[-1].endswith("not added ['5', '9', '10', 'A1']"))
+
+        # a group that isn't void is logged with its diagnostics instead of being listed as a voided check
+        del self.messages[:]
+        generator.write_groups([('1', twice)])
+        self.assertEqual(self.messages, ['1 - There was a problem deciphering the data, 2 rows could be the transaction '
+                                         '(2 rows, 0 positive totalling 0.00, 2 negative totalling -2.00)'])
+
+    def testGenerateStreaming(self):
+        memoryIif = os.path.join(self.dir, 'memory.iif')
+        streamIif = os.path.join(self.dir, 'stream.iif')
+
+        transactions = FileParser(self.csv, self.log_writer).parse_file()
+        IIFGenerator(memoryIif, self.log_writer).generate(transactions)
+        memoryMessages = list(self.messages)
+        del self.messages[:]
+
+        IIFGenerator(streamIif, self.log_writer).generate_streaming(FileParser(self.csv, self.log_writer), max_rows=1)
+
+        self.assertEqual(self.read(memoryIif), self.read(streamIif))
+        self.assertEqual(memoryMessages, self.messages)
+        self.assertEqual(self.read(memoryIif).count('\nENDTRNS\n'), 4)
+
+    def testWriteGroupsParallel(self):
+        serialIif = os.path.join(self.dir, 'serial.iif')
+        parallelIif = os.path.join(self.dir, 'parallel.iif')
+        transactions = FileParser(self.csv, self.log_writer).parse_file()
+        groups = list(group_transactions(transactions, count_transactions(transactions)))
+
+        IIFGenerator(serialIif, self.log_writer).write_groups(groups)
+        serialMessages = list(self.messages)
+        del self.messages[:]
+
+        IIFGenerator(parallelIif, self.log_writer).write_groups(groups, processes=2, chunk_size=1)
+
+        self.assertEqual(self.read(serialIif), self.read(parallelIif))
+        self.assertEqual(serialMessages, self.messages)
+        self.assertEqual(len(self.messages), 1)
+
+        # handlers and iif types set on the generator are used by the workers too
+        for processes, filename in ((None, serialIif), (2, parallelIif)):
+            generator = IIFGenerator(filename, self.log_writer)
+            generator.handlers = dict(IIFGenerator.handlers, Check=split_incoming)
+            generator.iif_types = dict(IIFGenerator.iif_types, Deposit='DEP')
+            generator.write_groups(groups, processes=processes, chunk_size=1)
+        self.assertEqual(self.read(serialIif), self.read(parallelIif))
+        self.assertTrue('\tDEP\t' in self.read(parallelIif))
+        self.assertEqual(self.read(parallelIif).count('\nENDTRNS\n'), 3)
+
+    def testConversionStats(self):
+        stats = ConversionStats()
+        IIFGenerator(os.path.join(self.dir, 'sample.iif'), self.log_writer, stats).generate_streaming(
+            FileParser(self.csv, self.log_writer, stats), max_rows=1)
+
+        self.assertEqual(stats.counters['rows'], 11)
+        self.assertEqual(stats.counters['account headers'], 6)
+        self.assertEqual(stats.counters['groups'], 5)
+        self.assertEqual(stats.counters['transactions written'], 4)
+        self.assertEqual(dict(stats.failures), {'VoidError': 1})
+        self.assertEqual(stats.as_dict()['largest_groups'][0], {'trans': '2', 'splits': 2})
+        for stage in ('count', 'csv read', 'get_data_row', 'grouping', 'decipher', 'write'):
+            self.assertTrue(stage in stats.seconds, stage)
+
+        del self.messages[:]
+        stats.report(self.log_writer)
+        self.assertTrue(self.messages[-1].startswith('Statistics: largest groups by split count 2 (2)'))
+
+    def testIncremental(self):
+        deltaIif = os.path.join(self.dir, 'sample.delta.iif')
+
+        convert_file(self.csv, self.log_writer, incremental=True)
+        self.assertEqual(self.read(deltaIif).count('\nENDTRNS\n'), 4)
+        self.assertEqual(len(TransactionIndex(os.path.join(self.dir, 'sample.iif.index')).digests), 4)
+        self.assertTrue("New transactions written ['1', '2', '3', '4']" in self.messages)
+
+        del self.messages[:]
+        convert_file(self.csv, self.log_writer, incremental=True, stream=True)
+        self.assertEqual(self.read(deltaIif), IIFGenerator.file_start_tpl)
+        self.assertTrue('4 unchanged transactions were skipped' in self.messages)
+
+        with open(self.csv, 'w') as f:
+            f.write(SAMPLE_CSV.replace('Bell,,,-SPLIT-', 'Bell,new memo,,-SPLIT-'))
+        del self.messages[:]
+        convert_file(self.csv, self.log_writer, incremental=True)
+        self.assertEqual(self.read(deltaIif).count('\nENDTRNS\n'), 1)
+        self.assertTrue('new memo' in self.read(deltaIif))
+        self.assertTrue("Changed transactions written ['2']" in self.messages)
+
+    def testParallelParse(self):
+        with open(self.csv, 'w') as f:
+            f.write(MULTILINE_CSV)
+        serial = FileParser(self.csv, self.log_writer).parse_file()
+        self.assertEqual(len(serial), 5)
+        self.assertEqual(serial[2]['AccountName'], ('Checking, main', 'Office'))
+        self.assertEqual(serial[4]['AccountName'], ('Savings',))
+
+        # one byte chunks put a chunk boundary after every record
+        parser = FileParser(self.csv, self.log_writer, processes=2)
+        self.assertEqual(list(parser.iter_rows_parallel(2, min_chunk_bytes=1)), serial)
+        self.assertEqual(parser.parse_file(), serial)
+
+        # both parsers read the bytes, so a windows export keeps the \r of a quoted field
+        with open(self.csv, 'wb') as f:
+            f.write(MULTILINE_CSV.replace('\n', '\r\n'))
+        serial = FileParser(self.csv, self.log_writer).parse_file()
+        self.assertEqual(serial[0]['Memo'], 'first line\r\nTotal Checking, main\r\nthird line')
+        self.assertEqual(list(FileParser(self.csv, self.log_writer, processes=2).iter_rows_parallel(2, min_chunk_bytes=1)), serial)
+
+        with open(self.csv, 'w') as f:
+            f.write(SAMPLE_CSV)
+        parser = FileParser(self.csv, self.log_writer, processes=3)
+        self.assertEqual(list(parser.iter_rows_parallel(3, min_chunk_bytes=1)),
+                         FileParser(self.csv, self.log_writer).parse_file())
+
+    def testMerge(self):
+        lines = SAMPLE_CSV.splitlines(True)
+        checking = os.path.join(self.dir, 'checking.csv')
+        others = os.path.join(self.dir, 'others.csv')
+        merged = os.path.join(self.dir, 'merged.iif')
+
+        # slices split every transaction between two files, and overlap the sample in one
+        with open(checking, 'w') as f:
+            f.writelines(lines[:8])
+        with open(others, 'w') as f:
+            f.writelines(lines[:1] + lines[8:])
+
+        convert_file(self.csv, self.log_writer)
+        expected = self.read(os.path.join(self.dir, 'sample.iif'))
+
+        convert_merged([checking, others], merged, self.log_writer, max_rows=2)
+        self.assertEqual(self.read(merged), expected)
+
+        del self.messages[:]
+        convert_merged([self.csv, checking, others], merged, self.log_writer, max_rows=2)
+        self.assertEqual(self.read(merged), expected)
+        self.assertTrue('11 duplicate rows found in more than one file were removed' in self.messages)
+
+        # a row repeated within one file is not a duplicate
+        rows = FileParser(self.csv, self.log_writer).parse_file()
+        merger = GroupMerger([rows + rows[:1], rows], max_rows=3, piece_size=2)
+        groups = list(merger)
+        self.assertEqual([ transId for transId, group in groups ], ['1', '2', '3', '4', '5'])
+        self.assertEqual(len(groups[0][1]), 3)
+        self.assertEqual(merger.duplicates, 11)
+
+        # merging one export gives exactly the groups of converting it, rows in file order
+        with open(self.csv, 'w') as f:
+            f.write(UNSORTED_CSV)
+        rows = FileParser(self.csv, self.log_writer).parse_file()
+        expected = sorted(group_transactions(rows, count_transactions(rows)), key=lambda group: trans_key(group[0]))
+        for maxRows, pieceSize in ((DEFAULT_MAX_ROWS, DEFAULT_CHUNK_SIZE), (1, 1)):
+            merger = GroupMerger([FileParser(self.csv, self.log_writer).iter_rows()], maxRows, pieceSize)
+            self.assertEqual(list(merger), expected)
+            self.assertEqual(merger.duplicates, 0)
+        convert_file(self.csv, self.log_writer)
+        convert_merged([self.csv, self.csv], merged, self.log_writer, max_rows=1)
+        self.assertEqual(self.read(merged), self.read(os.path.join(self.dir, 'sample.iif')))
+        self.assertTrue('TRNS\t\tGENERAL JOURNAL\t1/2/2008\tZions Checking\t\t-100.00\t' in self.read(merged))
+
+    def testRowFilter(self):
+        def parse(rowFilter, processes=None):
+            parser = FileParser(self.csv, self.log_writer, processes=processes, row_filter=rowFilter)
+            rows = parser.parse_file()
+            self.assertEqual(count_transactions(rows), parser.count_groups())
+            return [ (row['Trans #'], ':'.join(row['AccountName'])) for row in rows ]
+
+        self.assertEqual(parse(RowFilter(['Expenses'])),
+                         [('1', 'Expenses:Office'), ('2', 'Expenses:Office'), ('5', 'Expenses:Office'), ('2', 'Expenses:Phone')])
+        self.assertEqual(parse(RowFilter(['Exp*'], ['Expenses:Phone'])), parse(RowFilter(['Expenses:Office'])))
+        self.assertEqual(parse(RowFilter(exclude_accounts=['Checking', 'Expenses'], types=['Deposit', 'Transfer'])),
+                         [('3', 'Income'), ('4', 'Savings')])
+        self.assertEqual(parse(RowFilter(['Checking'], start='2008-01-06', end='1/8/2008')),
+                         [('2', 'Checking'), ('3', 'Checking'), ('4', 'Checking')])
+        self.assertEqual(parse(RowFilter(['Checking'], exclude_types=['Check']), processes=2),
+                         [('3', 'Checking'), ('4', 'Checking')])
+        self.assertRaises(ValueError, RowFilter, start='2008-13-01')
+
+        # only the split side of the checks is left, so they are recreated from it
+        convert_file(self.csv, self.log_writer, row_filter=RowFilter(['Expenses:Office']))
+        iif = self.read(os.path.join(self.dir, 'sample.iif'))
+        self.assertEqual(iif.count('\nENDTRNS\n'), 2)
+        self.assertTrue('TRNS\t\tCheck\t1/5/2008\tChecking\tAcme\t-100.00\t' in iif)
+        self.assertTrue('TRNS\t\tCheck\t1/6/2008\tChecking\tBell\t-50.00\t' in iif)
+        self.assertTrue(self.messages[-1].endswith("may be missing other splits ['1', '2']"))
+
+        # without a filter a group holding only the split side is not a transaction
+        rows = FileParser(self.csv, self.log_writer).parse_file()
+        groups = dict(group_transactions(rows, count_transactions(rows)))
+        generator = IIFGenerator(None, self.log_writer)
+        self.assertRaises(VoidError, generator.decipher_transactions, groups['1'][1:])
+        generator.filtered = True
+        self.assertEqual(generator.decipher_transactions(groups['1'][1:])[0]['Amount'], -10000)
+        self.assertEqual(generator.recreated, ['1'])
+
+    def testAccountIndex(self):
+        accounts = FileParser(self.csv, self.log_writer).account_index()
+        self.assertEqual(accounts.items(), [((), 0), (('Checking',), 5), (('Expenses',), 0), (('Expenses', 'Office'), 3),
+                                            (('Expenses', 'Phone'), 1), (('Income',), 1), (('Savings',), 1)])
+        out = StringIO.StringIO()
+        self.assertEqual(list_accounts([self.csv], out), EXIT_OK)
+        self.assertTrue('       0        4  Expenses\n       3        3    Office\n' in out.getvalue())
+        self.assertTrue(out.getvalue().endswith('       0       11  total\n'))
+
+    def testGoldenIif(self):
+        iif = os.path.join(self.dir, 'sample.iif')
+        for settings in ({}, {'stream': True, 'max_rows': 1}, {'processes': 2}, {'atomic': True}):
+            convert_file(self.csv, self.log_writer, **settings)
+            self.assertEqual(self.read(iif), SAMPLE_IIF)
+
+        # map rows with the account path as a list are still written
+        row = {'Type': 'Check', 'Date': '1/5/2008', 'Name': 'Acme', 'Num': '101', 'Memo': '', 'Clr': ''}
+        f = StringIO.StringIO()
+        IIFGenerator(iif, self.log_writer).write_transaction(dict(row, AccountName=['Checking'], Amount=-10000),
+                                                             [dict(row, AccountName=['Expenses', 'Office'], Amount=10000)], f)
+        self.assertEqual(f.getvalue(), ''.join(SAMPLE_IIF.splitlines(True)[3:6]))
+
+    def testIIFWriter(self):
+        iif = os.path.join(self.dir, 'sample.iif')
+        with open(iif, 'w') as f:
+            f.write('previous')
+
+        # an atomic writer leaves the old file alone until it is complete
+        with IIFWriter(iif, atomic=True, buffer_size=4) as f:
+            f.write('new ')
+            f.write('file')
+            self.assertEqual(self.read(iif), 'previous')
+            self.assertEqual(f.size, 0)
+        self.assertEqual(self.read(iif), 'new file')
+        self.assertFalse(os.path.exists(iif + '.tmp'))
+
+        try:
+            with IIFWriter(iif, atomic=True) as f:
+                f.write('broken')
+                raise Cancelled()
+        except Cancelled:
+            pass
+        self.assertEqual(self.read(iif), 'new file')
+        self.assertFalse(os.path.exists(iif + '.tmp'))
+
+        progress = ConversionProgress(Queue.Queue(), interval=1)
+        progress.cancel()
+        self.assertRaises(Cancelled, convert_file, self.csv, self.log_writer, stream=True, atomic=True, progress=progress)
+        self.assertEqual(self.read(iif), 'new file')
+
+    def testCompressed(self):
+        self.assertEqual(get_iif_filename('ledger.2008.csv.gz'), 'ledger.2008.iif')
+        self.assertEqual(get_iif_filename(os.path.join('a.b', 'ledger.csv'), 'bz2'), os.path.join('a.b', 'ledger.iif.bz2'))
+        self.assertEqual(get_delta_filename('ledger.2008.csv.xz', 'gz'), 'ledger.2008.delta.iif.gz')
+        self.assertEqual(get_stats_filename('all.iif.gz'), 'all.stats.json')
+
+        exports = [ os.path.join(self.dir, name) for name in ('ledger.2008.csv.gz', 'ledger.2009.csv.bz2') ]
+        with gzip.open(exports[0], 'wb') as f:
+            f.write(SAMPLE_CSV)
+        f = bz2.BZ2File(exports[1], 'w')
+        f.write(SAMPLE_CSV)
+        f.close()
+        self.assertEqual(map(get_compression, exports + [self.csv]), ['gz', 'bz2', None])
+
+        out = StringIO.StringIO()
+        self.assertEqual(convert_batch(exports, jobs=1, out=out, processes=2, compression='gz'), EXIT_OK)
+        for name in ('ledger.2008', 'ledger.2009'):
+            with gzip.open(os.path.join(self.dir, name + '.iif.gz')) as f:
+                self.assertEqual(f.read(), SAMPLE_IIF)
+            with gzip.open(os.path.join(self.dir, name + '.log.gz')) as f:
+                self.assertTrue('File created' in f.read())
+
+        # a compressed file can't be memory mapped, so parallel parsing falls back to reading it
+        self.assertEqual(FileParser(exports[0], self.log_writer, processes=2).parse_file(),
+                         FileParser(self.csv, self.log_writer).parse_file())
+
+    def testParseCache(self):
+        cacheDir = os.path.join(self.dir, 'cache')
+        iif = os.path.join(self.dir, 'sample.iif')
+        rowFilter = RowFilter(['Checking'], start='2008-01-06')
+        for settings in ({}, {'stream': True, 'max_rows': 1}, {'row_filter': rowFilter}, {'parse_processes': 2}):
+            expected = FileParser(self.csv, self.log_writer, row_filter=settings.get('row_filter')).parse_file()
+            for run in ('miss', 'hit'):
+                parser = FileParser(self.csv, self.log_writer, row_filter=settings.get('row_filter'), cache=ParseCache(cacheDir))
+                self.assertEqual(parser.parse_file(), expected)
+                self.assertEqual(parser.count_groups(), count_transactions(expected))
+                convert_file(self.csv, self.log_writer, cache=ParseCache(cacheDir), **settings)
+                if 'row_filter' not in settings:
+                    self.assertEqual(self.read(iif), SAMPLE_IIF)
+        self.assertEqual(FileParser(self.csv, self.log_writer, cache=ParseCache(cacheDir)).account_index().items(),
+                         FileParser(self.csv, self.log_writer).account_index().items())
+
+        # an export that changed is parsed again
+        entry, = [ os.path.join(cacheDir, name) for name in os.listdir(cacheDir) ]
+        self.assertNotEqual(CachedExport.read(entry, file_fingerprint(self.csv)), None)
+        with open(self.csv, 'w') as f:
+            f.write(SAMPLE_CSV.replace('Acme', 'Acne'))
+        self.assertEqual(CachedExport.read(entry, file_fingerprint(self.csv)), None)
+        rows = FileParser(self.csv, self.log_writer, cache=ParseCache(cacheDir)).parse_file()
+        self.assertEqual(rows, FileParser(self.csv, self.log_writer).parse_file())
+        self.assertTrue('Acne' in [ row['Name'] for row in rows ])
+
+        # amounts that aren't plain cents keep their type
+        accountPaths = collections.OrderedDict([((), ()), (('A',), ('A',))])
+        rows = [ Transaction((('A',), '1', 'Check', '', '1/1/2008', '', '', '', amount))
+                 for amount in (-5, Decimal('-0'), ZERO, 1 << 40, Decimal('1.005')) ]
+        export = CachedExport.from_rows(('size', 'mtime', 'md5'), rows, accountPaths)
+        with open(entry, 'wb') as f:
+            export.write(f)
+        read = CachedExport.read(entry, ('size', 'mtime', 'md5'))
+        self.assertEqual([ (row['Amount'], type(row['Amount'])) for row in read.iter_rows() ],
+                         [ (row['Amount'], type(row['Amount'])) for row in rows ])
+        self.assertEqual(str(list(read.iter_rows())[1]['Amount']), '-0')
+        self.assertEqual(read.count_groups(), ({'1': 5}, collections.OrderedDict([((), 0), (('A',), 5)])))
+        os.remove(entry)
+
+        # the least recently used entries are removed once the directory is full
+        exports = []
+        for i in xrange(3):
+            exports.append(os.path.join(self.dir, 'export%d.csv' % i))
+            shutil.copy(self.csv, exports[-1])
+        cache = ParseCache(cacheDir)
+        for i, filename in enumerate(exports):
+            FileParser(filename, self.log_writer, cache=cache).parse_file()
+            os.utime(cache.entry_filename(filename), (i, i))
+            cache.max_bytes = os.path.getsize(cache.entry_filename(filename)) * 5 // 2
+        self.assertEqual(sorted(os.listdir(cacheDir)), sorted([ os.path.basename(cache.entry_filename(filename))
+                                                              for filename in exports[1:] ]))
+
+    def testService(self):
+        self.assertEqual(parse_address('8000'), ('127.0.0.1', 8000))
+        self.assertEqual(parse_address('localhost'), ('localhost', 8750))
+        self.assertEqual((qbservice.EXIT_OK, qbservice.EXIT_PARSE_ERROR, qbservice.EXIT_ERROR),
+                         (EXIT_OK, EXIT_PARSE_ERROR, EXIT_ERROR))
+
+        # the service converts any file for anyone, so it stays on localhost unless told otherwise
+        self.assertTrue(is_loopback('localhost'))
+        self.assertFalse(is_loopback('0.0.0.0'))
+        self.assertRaises(ValueError, ConversionServer, ('0.0.0.0', 0), {}, 1)
+        ConversionServer(('0.0.0.0', 0), {}, 1, allow_remote=True).server_close()
+
+        for jobs in (1, 2):
+            server = ConversionServer(('127.0.0.1', 0), {'stream': True}, jobs)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                iif = os.path.join(self.dir, 'sample.iif')
+                out = StringIO.StringIO()
+                self.assertEqual(convert_remote([self.csv], server.server_address, out=out, token=server.token), EXIT_OK)
+                self.assertEqual(out.getvalue(), '0\t%s\t%s\nConverted 1 of 1 files\n' % (self.csv, iif))
+                self.assertEqual(self.read(iif), SAMPLE_IIF)
+
+                # an uploaded export is converted in the service's own directory
+                upload = os.path.join(self.dir, 'upload')
+                os.mkdir(upload)
+                shutil.copy(self.csv, upload)
+                broken = os.path.join(upload, 'broken.csv')
+                with open(broken, 'w') as f:
+                    f.write('nothing,useful\n')
+                out = StringIO.StringIO()
+                self.assertEqual(convert_remote([upload], server.server_address, upload=True, out=out, token=server.token),
+                                 EXIT_PARSE_ERROR)
+                self.assertEqual(self.read(os.path.join(upload, 'sample.iif')), SAMPLE_IIF)
+                self.assertTrue('File created' in self.read(os.path.join(upload, 'sample.log')))
+                self.assertTrue('1\t%s\tThe necessary column' % broken in out.getvalue())
+                shutil.rmtree(upload)
+
+                # a post a web page could make, or one without the token, is refused before anything is touched
+                notes = os.path.join(self.dir, 'notes.log')
+                with open(notes, 'w') as f:
+                    f.write('kept')
+                body = json.dumps({'path': os.path.join(self.dir, 'notes.csv')})
+                for headers, status in (({'Content-Type': 'text/plain', 'X-QBExport-Token': server.token}, 415),
+                                        ({'Content-Type': 'application/json'}, 403),
+                                        ({'Content-Type': 'application/json', 'X-QBExport-Token': server.token}, 200)):
+                    connection = httplib.HTTPConnection(*server.server_address)
+                    connection.request('POST', '/convert', body, headers)
+                    response = connection.getresponse()
+                    self.assertEqual(response.status, status)
+                    data = response.read()
+                    connection.close()
+                self.assertTrue('No such export file' in json.loads(data)['messages'][0])
+                self.assertEqual(self.read(notes), 'kept')
+                out = StringIO.StringIO()
+                self.assertEqual(convert_remote([self.csv], server.server_address, out=out, token='wrong'), EXIT_ERROR)
+                self.assertTrue('refused the request: 403' in out.getvalue())
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def testProgress(self):
+        updates = Queue.Queue()
+        progress = ConversionProgress(updates, interval=1)
+        self.assertEqual(convert_file(self.csv, self.log_writer, stream=True, progress=progress),
+                         os.path.join(self.dir, 'sample.iif'))
+        self.assertEqual((progress.rows, progress.groups, progress.failures, progress.total), (11, 5, 1, 5))
+
+        # the lines of the first pass are counted before any row is parsed
+        posted = [ updates.get_nowait() for i in range(updates.qsize()) ]
+        counting = [ value for kind, value in posted if kind == 'counting' ]
+        self.assertEqual(counting, range(1, len(SAMPLE_CSV.splitlines())))
+        self.assertEqual(posted[len(counting)], ('progress', (1, 0, 0, 5)))
+
+        # and a conversion can be cancelled while they are
+        progress = ConversionProgress(Queue.Queue(), interval=1)
+        progress.cancel()
+        parser = FileParser(self.csv, self.log_writer)
+        parser.progress = progress
+        self.assertRaises(Cancelled, parser.count_groups)
+
+    def testCancel(self):
+        iif = os.path.join(self.dir, 'sample.iif')
+
+        class CancellingQueue(Queue.Queue):
+            # cancel as soon as the first transaction has been written
+            def put(self, item):
+                Queue.Queue.put(self, item)
+                if item[0] == 'progress' and item[1][1]:
+                    progress.cancel()
+
+        progress = ConversionProgress(CancellingQueue(), interval=1)
+        self.assertRaises(Cancelled, convert_file, self.csv, self.log_writer, stream=True, progress=progress)
+        self.assertFalse(os.path.exists(iif))
+
+        # an iif file this conversion never opened is left alone
+        convert_file(self.csv, self.log_writer)
+        progress = ConversionProgress(Queue.Queue(), interval=1)
+        progress.cancel()
+        self.assertRaises(Cancelled, convert_file, self.csv, self.log_writer, progress=progress)
+        self.assertEqual(self.read(iif), SAMPLE_IIF)
+        os.remove(iif)
+
+        progress = ConversionProgress(Queue.Queue(), interval=1)
+        progress.cancel()
+        convert_in_background(self.csv, self.log_writer, progress, {})
+        self.assertEqual(progress.result, EXIT_ERROR)
+        self.assertEqual(self.messages[-1], 'Conversion cancelled, no file was created')
+        self.assertFalse(os.path.exists(iif))
+
+    def testCheckpoint(self):
+        iif = os.path.join(self.dir, 'sample.iif')
+        checkpoint = iif + '.checkpoint'
+        writeGroup = IIFGenerator.write_group
+
+        class Crash(Exception):
+            pass
+
+        def crashing_write_group(self, transId, transactions, f):
+            # stop like a killed process once two groups have been written
+            written.append(transId)
+            if len(written) > 2:
+                raise Crash()
+            return writeGroup(self, transId, transactions, f)
+
+        for settings in ({}, {'atomic': True}):
+            written = []
+            IIFGenerator.write_group = crashing_write_group
+            try:
+                self.assertRaises(Crash, convert_file, self.csv, self.log_writer, checkpoint_rows=1, **settings)
+            finally:
+                IIFGenerator.write_group = writeGroup
+            self.assertTrue(os.path.exists(checkpoint))
+            self.assertTrue(os.path.exists(checkpoint + '.spill'))
+            with open(settings and iif + '.tmp' or iif, 'ab') as f:
+                f.write('written after the checkpoint')
+
+            convert_file(self.csv, self.log_writer, checkpoint_rows=1, resume=True, **settings)
+            self.assertEqual(self.read(iif), SAMPLE_IIF)
+            self.assertFalse(os.path.exists(checkpoint))
+            self.assertFalse(os.path.exists(checkpoint + '.spill'))
+            voids = [ message for message in self.messages if message.startswith('Some transactions could not be written') ]
+            self.assertEqual(len(voids), 1)
+            self.assertTrue(voids[0].endswith("['5']"))
+            del self.messages[:]
+
+        # stopped after the atomic rename, before the checkpoint was removed
+        removeCheckpoint = Checkpoint.remove
+        def crashing_remove(self):
+            raise Crash()
+        Checkpoint.remove = crashing_remove
+        try:
+            self.assertRaises(Crash, convert_file, self.csv, self.log_writer, checkpoint_rows=1, atomic=True)
+        finally:
+            Checkpoint.remove = removeCheckpoint
+        self.assertFalse(os.path.exists(iif + '.tmp'))
+        del self.messages[:]
+        convert_file(self.csv, self.log_writer, checkpoint_rows=1, resume=True, atomic=True)
+        self.assertEqual(self.read(iif), SAMPLE_IIF)
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertTrue(self.messages[-1].endswith("['5']"))
+
+        # a checkpoint of an export that has since changed is not resumed
+        Checkpoint(checkpoint, 1, False).save({'source': (0, 0)})
+        self.assertRaises(ValueError, convert_file, self.csv, self.log_writer, resume=True)
+        self.assertRaises(ValueError, convert_file, self.csv, self.log_writer, checkpoint_rows=1, compression='gz')
+
+    def testConvertBatch(self):
+        shutil.copy(self.csv, os.path.join(self.dir, 'second.csv'))
+        with open(os.path.join(self.dir, 'broken.csv'), 'w') as f:
+            f.write('nothing,useful\n')
+
+        out = StringIO.StringIO()
+        exitCode = convert_batch([self.dir], jobs=2, stream=True, out=out)
+
+        self.assertEqual(exitCode, EXIT_PARSE_ERROR)
+        self.assertTrue('Converted 2 of 3 files' in out.getvalue())
+        self.assertEqual(self.read(os.path.join(self.dir, 'sample.iif')), self.read(os.path.join(self.dir, 'second.iif')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'broken.log')))
+
 
 if __name__ == '__main__':
     unittest.main()